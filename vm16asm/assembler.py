@@ -21,13 +21,12 @@
 import re
 import sys
 import os
-import pprint
-import struct
 from .instructions import *
-from copy import copy
 from array import array
 
 DEST_PATH = ""
+lOutputLog = []     # output lines of the current run
+lOutputFiles = []   # files generated by the current run
 
 reLABEL = re.compile(r"^([A-Za-z_][A-Za-z_0-9\.]+):")
 reCONST = re.compile(r"#(\$?[0-9A-Fa-fx]+)$")
@@ -35,10 +34,25 @@ reADDR = re.compile(r"(\$?[0-9A-Fa-fx]+)$")
 reREL  = re.compile(r"([\+\-])(\$?[0-9A-Fa-fx]+)$")
 reSTACK = re.compile(r"\[SP\+(\$?[0-9A-Fa-fx]+)\]$")
 reINCL =  re.compile(r'^\$include +"(.+?)"')
+reCOND = re.compile(r'^\$(if|ifdef|ifndef|else|endif)\b *(.*)$')
 reMACRO_DEF = re.compile(r'^\$macro +([A-Za-z_][A-Za-z_0-9\.]+) *([0-9]?)$')
 reMACRO =  re.compile(r'^([A-Za-z_][A-Za-z_0-9\.]+) *(.*)$')
-reEQUALS = re.compile(r"^([A-Za-z_][A-Za-z_0-9\.]+) *= *(\S+)")
+reEQUALS = re.compile(r"^([A-Za-z_][A-Za-z_0-9\.]+) *= *(.+)$")
+reIDENT = re.compile(r"^[A-Za-z_][A-Za-z_0-9\.]*$")
 rePARAM = re.compile(r'^\-[cls]{1,3}')
+reEXPR = re.compile(r"[*/%&|()<>=!]|[\w\$]\s*[-+]")
+reEXPR_TOKEN = re.compile(r"\s*(\$[0-9A-Fa-f]+|0x[0-9A-Fa-f]+|[0-9]+|[A-Za-z_][A-Za-z_0-9\.]*|<<|>>|<=|>=|==|!=|[-+*/%&|()<>])")
+reEXPR_BINOP = re.compile(r"\s*(<<|>>|<=|>=|==|!=|[*/%&|<>])\s*")
+reEXPR_ADDOP = re.compile(r"\s+([-+])\s+")
+reEXPR_OPEN = re.compile(r"\(\s+")
+reEXPR_CLOSE = re.compile(r"\s+\)")
+
+# Expression operators with precedence
+ExprOperators = {
+    "|": 1, "&": 2, "==": 3, "!=": 3,
+    "<": 4, ">": 4, "<=": 4, ">=": 4, "<<": 5, ">>": 5,
+    "+": 6, "-": 6, "*": 7, "/": 7, "%": 7,
+}
 
 # Token tuple indexes
 FILENAME = 0
@@ -57,7 +71,13 @@ BTEXTTYPE = 2
 DATATYPE = 3
 COMMENT = 4
 
+# Number of source lines per token list segment (watch mode)
+SEGMENT_LINES = 64
+
 def outp(s, new=False):
+    if new:
+        del lOutputLog[:]
+    lOutputLog.append(s)
     if "--srv" in sys.argv:
         outfile = DEST_PATH + "pipe.sys"
         if new:
@@ -66,9 +86,150 @@ def outp(s, new=False):
             open(outfile, "a").write(s+"\n")
     print(s)
 
+def write_file(path, fname, data):
+    if isinstance(data, bytes):
+        open(path + fname, "wb").write(data)
+    else:
+        open(path + fname, "wt").write(data)
+    lOutputFiles.append(fname)
+
 def startswith(s, keyword):
     return s.split(" ")[0] == keyword
     
+def join_expression(s):
+    """
+    Remove the blanks within expressions like 'table + 2 * IDX',
+    so that the expression forms one operand word.
+    '+' and '-' are only binary operators with blanks on both sides,
+    otherwise they are prefixes like in 'jump +loop'.
+    """
+    s = reEXPR_BINOP.sub(r"\1", s)
+    s = reEXPR_ADDOP.sub(r"\1", s)
+    s = reEXPR_OPEN.sub("(", s)
+    return reEXPR_CLOSE.sub(")", s)
+
+def is_expression(s):
+    return s[0] != "[" and reEXPR.search(s) is not None
+
+def expr_tokens(s):
+    lTok = []
+    pos = 0
+    s = s.rstrip()
+    while pos < len(s):
+        m = reEXPR_TOKEN.match(s, pos)
+        if not m:
+            raise ValueError("Invalid expression")
+        lTok.append(m.group(1))
+        pos = m.end()
+    return lTok
+
+def number(s):
+    if s[0] == "$":
+        return int(s[1:], base=16)
+    elif s[0:2] == "0x":
+        return int(s[2:], base=16)
+    elif s[0] == "0":
+        return int(s, base=8)
+    return int(s, base=10)
+
+def operation(op, val1, val2):
+    if op == "+": return val1 + val2
+    if op == "-": return val1 - val2
+    if op == "*": return val1 * val2
+    if op in ["/", "%"]:
+        if val2 == 0:
+            raise ValueError("Division by zero")
+        return val1 // val2 if op == "/" else val1 % val2
+    if op in ["<<", ">>"]:
+        if val2 < 0 or val2 > 16:
+            raise ValueError("Invalid shift value %d" % val2)
+        return val1 << val2 if op == "<<" else val1 >> val2
+    if op == "&": return val1 & val2
+    if op == "|": return val1 | val2
+    if op == "==": return int(val1 == val2)
+    if op == "!=": return int(val1 != val2)
+    if op == "<": return int(val1 < val2)
+    if op == ">": return int(val1 > val2)
+    if op == "<=": return int(val1 <= val2)
+    return int(val1 >= val2)
+
+def evaluate(s, lookup):
+    """
+    Evaluate a constant expression like 'table+2*IDX' with the operators
+    + - * / % << >> & | and parentheses, and the comparisons
+    == != < > <= >= (result 0 or 1).
+    'lookup' is called for each identifier and returns its value, or None
+    if the identifier is not (yet) known.
+    Return the 16 bit value or None for unresolved identifiers.
+    Raise ValueError on syntax errors and overflows.
+    """
+    lTok = expr_tokens(s) + [None]
+    state = {"idx": 0, "unresolved": False}
+
+    def next_token():
+        tok = lTok[state["idx"]]
+        if tok is None:
+            raise ValueError("Invalid expression")
+        state["idx"] += 1
+        return tok
+
+    def unary():
+        tok = next_token()
+        if tok == "(":
+            val = binary(1)
+            if lTok[state["idx"]] != ")":
+                raise ValueError("Missing ')'")
+            state["idx"] += 1
+            return val
+        if tok == "-":
+            return -unary()
+        if tok == "+":
+            return unary()
+        if tok[0] in "$0123456789":
+            try:
+                return number(tok)
+            except ValueError:
+                raise ValueError("Invalid number '%s'" % tok)
+        if tok[0].isalpha() or tok[0] == "_":
+            val = lookup(tok)
+            if val is None:
+                state["unresolved"] = True
+                return 0
+            return val
+        raise ValueError("Invalid expression")
+
+    def binary(prec):
+        val1 = unary()
+        while True:
+            op = lTok[state["idx"]]
+            if op not in ExprOperators or ExprOperators[op] < prec:
+                return val1
+            state["idx"] += 1
+            val2 = binary(ExprOperators[op] + 1)
+            if not state["unresolved"]:
+                val1 = operation(op, val1, val2)
+
+    val = binary(1)
+    if lTok[state["idx"]] is not None:
+        raise ValueError("Invalid expression")
+    if state["unresolved"]:
+        return None
+    if val < -0x8000 or val > 0xFFFF:
+        raise ValueError("Value overflow (%d)" % val)
+    return val & 0xFFFF
+
+def defines():
+    """
+    Return the command line defines '-D NAME=VAL' as dict {NAME: "VAL"}
+    """
+    dDefines = {}
+    for idx, item in enumerate(sys.argv):
+        if item.startswith("-D"):
+            s = item[2:] or (sys.argv[idx + 1] if idx + 1 < len(sys.argv) else "")
+            name, _, val = s.partition("=")
+            dDefines[name] = val or "1"
+    return dDefines
+
 def parameter():
     for item in sys.argv:
         if rePARAM.match(item):
@@ -82,36 +243,89 @@ class Tokenizer(object):
     This include:
     - import $include files
     - expand macros
+    - conditional assembly ($if, $ifdef, $ifndef, $else, $endif)
     """
-    def __init__(self):
+    def __init__(self, dLines=None, dDefines=None, dParts=None):
         self.lPathList = []
+        self.lFiles = []
         self.dMacros = {}
+        self.sMacroKey = None           # cached 'macro_key' result
+        self.dDefines = dDefines or {}  # command line defines {name: value-string}
+        self.dAliases = {}              # aliases for conditions {ns.name: value}
+        self.lExprStack = []
+        # file lines cache {filename: lines}, shared in watch mode
+        self.dLines = {} if dLines is None else dLines
+        # file parts (blocks of SEGMENT_LINES lines, split at the includes)
+        # of the previous and this run {(filename, line-idx): part},
+        # see 'tokenize_part'
+        self.dOldParts = dParts or {}
+        self.dParts = {}
+        self.lSegments = []             # token lists of all file parts
+        self.lEvents = []               # alias definitions and lookups of the part
+        # alias uses in conditions for the cross reference
+        # [(name, (file, line, None))] of all parts and of the current part
+        self.lUses = []
+        self.lPartUses = []
+        self.site = None                # (file, line, None) of the condition
         
     def error(self, filename, lineno, err):
         outp("Error in file %s(%u):\n%s" % (filename, lineno, err))
         sys.exit(-1)
     
-    def find_file(self, path, filename):
+    def resolve_file(self, path, filename):
         # Server mode needs special handling due to the lack of dirs 
         # and the UID as file name prefix.
         if "--srv" in sys.argv:
             filename = path + os.path.basename(filename)
             path, basename = filename.rsplit("_", 1)
             path = path + "_"
-            namespace = os.path.splitext(basename)[0]
-            if os.path.exists(filename):
-                return filename, path, basename, namespace
-            outp("Error: File '%s' missing" % basename)
         else:
             filename = os.path.realpath(os.path.join(path, filename))
             path = os.path.dirname(filename)
             basename = os.path.basename(filename)
-            namespace = os.path.splitext(basename)[0]
-            if os.path.exists(filename):
-                return filename, path, basename, namespace
+        namespace = os.path.splitext(basename)[0]
+        return filename, path, basename, namespace
+    
+    def find_file(self, path, filename):
+        filename, path, basename, namespace = self.resolve_file(path, filename)
+        if os.path.exists(filename):
+            return filename, path, basename, namespace
+        if "--srv" in sys.argv:
+            outp("Error: File '%s' missing" % basename)
+        else:
             outp("Error: File '%s' missing" % filename)
         sys.exit(-1)
     
+    def include_files(self, path, filename, lFiles=None):
+        """
+        Return a list with (filename, file-content) of the given file and all
+        (transitive) include files, without tokenizing them.
+        Missing files are skipped, these will be reported by 'load_file'.
+        """
+        if lFiles is None:
+            lFiles = []
+        filename, path, basename, namespace = self.resolve_file(path, filename)
+        if filename in [item[0] for item in lFiles] or not os.path.exists(filename):
+            return lFiles
+        data = open(filename, "rb").read()
+        lFiles.append((filename, data))
+        for line in data.decode("utf-8", "replace").splitlines():
+            m = reINCL.match(line.strip())
+            if m:
+                self.include_files(path, m.group(1), lFiles)
+        return lFiles
+    
+    def read_lines(self, filename):
+        """
+        Return the lines of the file. For unchanged files, the cached list
+        is returned, so that the list identity stands for the file content.
+        """
+        lines = open(filename).readlines()
+        if self.dLines.get(filename) == lines:
+            return self.dLines[filename]
+        self.dLines[filename] = lines
+        return lines
+    
     def expand_macro(self, match, filename, lineno, line):
         name = match.group(1)
         params = match.group(2).split()
@@ -134,6 +348,104 @@ class Tokenizer(object):
             tokens.append((filename, lineno, item))
         return tokens  
         
+    def cond_symbol(self, ident):
+        """
+        Return the value of a define or an alias used in a condition
+        """
+        if ident in self.dDefines:
+            if ident in self.lExprStack:
+                raise ValueError("Recursive define '%s'" % ident)
+            self.lExprStack.append(ident)
+            try:
+                return evaluate(join_expression(self.dDefines[ident]), self.cond_symbol)
+            finally:
+                self.lExprStack.pop()
+        if "." not in ident:
+            ident = self.namespace + "." + ident
+        return self.alias_value(ident)
+    
+    def alias_value(self, name):
+        val = self.dAliases.get(name)
+        self.lEvents.append(("?", name, val))
+        if val is not None and self.site:
+            self.lPartUses.append((name, self.site))
+        return val
+    
+    def add_aliase(self, match):
+        """
+        Store the alias value for conditions (aliases with labels are ignored)
+        """
+        name = match.group(1)
+        if "." not in name:
+            name = self.namespace + "." + name
+        try:
+            val = evaluate(join_expression(match.group(2).split(";")[0]), self.cond_symbol)
+        except ValueError:
+            val = None
+        if val is not None:
+            self.dAliases[name] = val
+            self.lEvents.append(("=", name, val))
+    
+    def condition(self, lCond, match, filename, lineno):
+        """
+        Handle a conditional assembly directive with the stack 'lCond' of
+        [active, else-seen, parent-active] entries.
+        """
+        directive, arg = match.group(1), match.group(2).split(";")[0].strip()
+        active = not lCond or lCond[-1][0]
+        if directive in ["if", "ifdef", "ifndef"]:
+            cond = False
+            self.site = (filename, lineno, None)
+            if active and directive == "if":
+                try:
+                    val = evaluate(join_expression(arg), self.cond_symbol)
+                except ValueError as e:
+                    self.error(filename, lineno, "%s in condition '%s'" % (e, arg))
+                if val is None:
+                    self.error(filename, lineno, "Unknown symbol in condition '%s'" % arg)
+                cond = val != 0
+            elif directive != "if" and not arg:
+                self.error(filename, lineno, "Missing name in $%s" % directive)
+            elif directive != "if" and not reIDENT.match(arg):
+                self.error(filename, lineno, "Invalid name '%s' in $%s" % (arg, directive))
+            elif active:
+                if "." not in arg and arg not in self.dDefines:
+                    arg = self.namespace + "." + arg
+                cond = arg in self.dDefines or self.alias_value(arg) is not None
+                cond = cond if directive == "ifdef" else not cond
+            self.site = None
+            lCond.append([active and cond, False, active])
+        elif not lCond:
+            self.error(filename, lineno, "$%s without $if" % directive)
+        elif directive == "else":
+            if lCond[-1][1]:
+                self.error(filename, lineno, "Invalid $else")
+            lCond[-1] = [lCond[-1][2] and not lCond[-1][0], True, lCond[-1][2]]
+        else:
+            lCond.pop()
+    
+    def load_snapshot(self, filename, lNameSpaces):
+        """
+        Load the snapshot file (.v16s) of the given .asm file, if available
+        and up to date. The name spaces of the snapshot must not be loaded
+        before. Return the snapshot data or None.
+        """
+        from . import snapshot
+        snapname = os.path.splitext(filename)[0] + snapshot.EXT
+        if not os.path.exists(snapname):
+            return None
+        dSnap = snapshot.read(snapname, self.dDefines)
+        if not dSnap or [ns for ns in dSnap["namespaces"] if ns in lNameSpaces]:
+            return None
+        outp(" - load snapshot %s..." % os.path.basename(snapname))
+        lNameSpaces.extend(dSnap["namespaces"])
+        self.lFiles.extend([item[0] for item in dSnap["files"]])
+        self.dMacros.update(dSnap["macros"])
+        self.sMacroKey = None
+        self.dAliases.update(dSnap["aliases"])
+        self.lUses.extend(dSnap["uses"])
+        return dSnap
+    
     def load_file(self, path, filename, lNameSpaces=[]):
         """
         Read ASM file with all include files.
@@ -142,60 +454,169 @@ class Tokenizer(object):
         Return a token list with (namespace, line-no, line-string) 
         """
         filename, path, basename, namespace = self.find_file(path, filename)
-        macro_name = False
     
         lToken = []
     
         if namespace not in lNameSpaces:
+            dSnap = self.load_snapshot(filename, lNameSpaces)
+            if dSnap:
+                self.lSegments.append(dSnap["tokens"])
+                return dSnap["tokens"], lNameSpaces
             lNameSpaces.append(namespace)
+            self.lFiles.append(filename)
             self.namespace = namespace
-    
-            lToken.append((basename, 0, ""))
-            lToken.append((basename, 0, ";############ File: %s ############" % basename))
-            lineno = 0
             try:
-                lines = open(filename).readlines()
+                lines = self.read_lines(filename)
             except:
-                self.error(basename, lineno, "Invalid file format")
-            for idx, line in enumerate(lines):
-                lineno += 1
-                clean_line = line.strip()
-                # include files
-                m = reINCL.match(clean_line)
-                if m:
-                    fname = m.group(1)
+                self.error(basename, 0, "Invalid file format")
+            idx, lCond, macro_name = 0, [], False
+            while True:
+                part = self.cached_part(filename, lines, idx, lCond, macro_name)
+                if part:
+                    self.apply_part(part)
+                else:
+                    part = self.tokenize_part(basename, lines, idx, lCond, macro_name)
+                self.dParts[(filename, idx)] = part
+                self.lSegments.append(part["tokens"])
+                self.lUses.extend(part["uses"])
+                lToken.extend(part["tokens"])
+                idx, lCond, macro_name, fname = part["next"]
+                if fname:
+                    # include file
                     outp(" - import %s..." % os.path.basename(fname))
                     t, _ = self.load_file(path, fname, lNameSpaces)
                     lToken.extend(t)
+                    self.namespace = namespace
+                elif idx >= len(lines):
+                    break
+        return lToken, lNameSpaces
+
+    def macro_key(self):
+        if self.sMacroKey is None:
+            self.sMacroKey = repr(sorted(self.dMacros.items()))
+        return self.sMacroKey
+
+    def cached_part(self, filename, lines, idx, lCond, macro_name):
+        """
+        Return the part of the previous run, if the file content, the defines,
+        the macros, the conditional assembly state, and the used aliases
+        are unchanged, otherwise None.
+        """
+        part = self.dOldParts.get((filename, idx))
+        if not part or part["defines"] != self.dDefines or \
+                part["state"] != (lCond, macro_name) or part["macros"] != self.macro_key() or \
+                part["lines"] != lines[idx:part["next"][0]]:
+            return None
+        dOverlay = {}
+        for kind, name, val in part["events"]:
+            if kind == "=":
+                dOverlay[name] = val
+            elif dOverlay.get(name, self.dAliases.get(name)) != val:
+                return None
+        return part
+
+    def apply_part(self, part):
+        for kind, name, val in part["events"]:
+            if kind == "=":
+                self.dAliases[name] = val
+        for name, lLines in part["macros_out"].items():
+            self.dMacros[name] = list(lLines)
+            self.sMacroKey = None
+
+    def tokenize_part(self, basename, lines, idx, lCond, macro_name):
+        """
+        Tokenize the file lines from 'idx' up to the next $include, the next
+        block of SEGMENT_LINES lines, or the end of the file. Return the part
+        as dict with the tokens, the macro and alias definitions, and the state
+        for the next part.
+        """
+        start = idx
+        part = {"defines": dict(self.dDefines),
+                "state": ([list(c) for c in lCond], macro_name), "macros": self.macro_key()}
+        lCond = [list(c) for c in lCond]
+        lMacros = [macro_name] if macro_name else []
+        self.lEvents = []
+        self.lPartUses = []
+        lToken = []
+        fname = None
+        if idx == 0:
+            lToken.append((basename, 0, ""))
+            lToken.append((basename, 0, ";############ File: %s ############" % basename))
+        lineno = idx
+        while idx < len(lines):
+            if idx > start and idx % SEGMENT_LINES == 0:
+                break
+            line = lines[idx]
+            idx += 1
+            lineno = idx
+            clean_line = line.strip()
+            # conditional assembly, inactive lines are skipped unparsed
+            if not macro_name and clean_line[0:1] == "$":
+                m = reCOND.match(clean_line)
+                if m:
+                    self.condition(lCond, m, basename, lineno)
+                    lToken.append((basename, lineno, "; " + line))
                     continue
-                # end of macro definition
-                if macro_name and startswith(clean_line, "$endmacro"):
-                    macro_name = False
-                # code of macro definition
-                elif macro_name:
-                    self.dMacros[macro_name].append(line)
-                # start of macro definition
-                elif startswith(clean_line, "$macro"):
-                    m = reMACRO_DEF.match(clean_line)
-                    if m:
-                        macro_name = m.group(1)
-                        num_param = int(m.group(2) or "0")
-                        self.dMacros[macro_name] = [num_param]
-                        lToken.append((basename, lineno, "; " + line))
-                    else:
-                        self.error(basename, lineno, "Invalid macro syntax")
+            if lCond and not lCond[-1][0]:
+                continue
+            # include files
+            m = reINCL.match(clean_line)
+            if m:
+                fname = m.group(1)
+                break
+            # end of macro definition
+            if macro_name and startswith(clean_line, "$endmacro"):
+                macro_name = False
+            # code of macro definition
+            elif macro_name:
+                self.dMacros[macro_name].append(line)
+                self.sMacroKey = None
+            # start of macro definition
+            elif startswith(clean_line, "$macro"):
+                m = reMACRO_DEF.match(clean_line)
+                if m:
+                    macro_name = m.group(1)
+                    num_param = int(m.group(2) or "0")
+                    self.dMacros[macro_name] = [num_param]
+                    self.sMacroKey = None
+                    lMacros.append(macro_name)
+                    lToken.append((basename, lineno, "; " + line))
                 else:
-                    # expand macro 
-                    m = reMACRO.match(clean_line)
-                    if m and m.group(1) in self.dMacros:
-                        lToken.extend(self.expand_macro(m, basename, lineno, line))
-                        continue
-                    lToken.append((basename, lineno, line))
-        return lToken, lNameSpaces
+                    self.error(basename, lineno, "Invalid macro syntax")
+            else:
+                # expand macro 
+                m = reMACRO.match(clean_line)
+                if m and m.group(1) in self.dMacros:
+                    lToken.extend(self.expand_macro(m, basename, lineno, line))
+                    continue
+                m = reEQUALS.match(clean_line)
+                if m:
+                    self.add_aliase(m)
+                lToken.append((basename, lineno, line))
+        if not fname and idx >= len(lines) and lCond:
+            self.error(basename, lineno, "Missing $endif")
+        part["lines"] = lines[start:idx]
+        part["tokens"] = lToken
+        part["events"] = self.lEvents
+        part["uses"] = self.lPartUses
+        part["macros_out"] = dict([(name, list(self.dMacros[name])) for name in lMacros])
+        part["next"] = (idx, lCond, macro_name, fname)
+        return part
 
 class AsmBase(object):
-    def __init__(self, lNameSpaces):
+    def __init__(self, lNameSpaces, dXRef=None):
         self.lNameSpaces = lNameSpaces
+        self.dNameSpaces = dict.fromkeys(lNameSpaces, True)  # for fast lookups
+        self.ispass2 = False
+        self.lExprStack = []
+        self.dIdents = {}       # {(namespace, ident): expanded ident}
+        self.dFileSpaces = {}   # {filename: namespace}
+        # cross reference {symbol: {"def": (file, line, addr), "uses": set of (file, line, addr)}}
+        self.dXRef = {} if dXRef is None else dXRef
+        self.dDefines = {}
+        # symbol/alias lookups and definitions of the current token list
+        # segment for the reuse of the results in watch mode (or None)
+        self.dSeg = None
 
     def error(self, err):
         filename = self.token[FILENAME]
@@ -246,10 +667,15 @@ class AsmBase(object):
         """
         10 bit const value like in 'sys #123' 
         """
+        s = self.aliases(s)
+        if s[0] == "#" and not reCONST.match(s):
+            return self.expression(s[1:]) % 1024
         try:
             if s[0] == "#":
                 if s[1] == "$":
                     return int(s[2:], base=16) % 1024
+                if s[1:3] == "0x":
+                    return int(s[3:], base=16) % 1024
                 return int(s[1:], base=10) % 1024
             else:
                 self.error("Invalid oprnd in '%s'" % self.line)
@@ -258,48 +684,201 @@ class AsmBase(object):
             
     def value(self, s):
         try:
-            if s[0] == "$":
-                return int(s[1:], base=16)
-            elif s[0:2] == "0x":
-                return int(s[2:], base=16)
-            elif s[0] == "0":
-                return int(s, base=8)
-            return int(s, base=10)
+            return number(s)
         except:
             self.error("Invalid oprnd in '%s'" % self.line)
 
+    def expression(self, s):
+        """
+        Evaluate the constant expression 's' with numbers, aliases and labels.
+        In pass 1, None is returned if a label is not yet known.
+        """
+        try:
+            return evaluate(s, self.expr_symbol)
+        except ValueError as e:
+            self.error("%s in '%s'" % (e, self.line))
+
+    def expr_symbol(self, ident):
+        """
+        Return the value of an alias or label used in an expression
+        """
+        label = self.expand_ident(self.namespace, ident)
+        s = self.get_alias(label)
+        addr = self.get_symbol(label) if s is None else None
+        if s is not None or addr is not None:
+            self.add_use(label)
+        if s is not None:
+            if label in self.lExprStack:
+                raise ValueError("Recursive alias '%s'" % ident)
+            if s[0] == "#":
+                s = s[1:]
+            self.lExprStack.append(label)
+            try:
+                return evaluate(s, self.expr_symbol)
+            finally:
+                self.lExprStack.pop()
+        if addr is not None:
+            return addr
+        if self.ispass2:
+            raise ValueError("Invalid oprnd")
+        return None
+
+    def fold_expression(self, s):
+        """
+        Fold the alias expression 's' into a value. If a label is not yet
+        known, the expression is kept with fully qualified identifiers
+        to be evaluated in pass 2.
+        """
+        prefix = "#" if s[0] == "#" else ""
+        s = s[len(prefix):]
+        val = self.expression(s)
+        if val is not None:
+            return prefix + "$%X" % val
+        lOut = []
+        for tok in expr_tokens(s):
+            if tok[0].isalpha() or tok[0] == "_":
+                tok = self.expand_ident(self.namespace, tok) or tok
+            lOut.append(tok)
+        return prefix + "(" + "".join(lOut) + ")"
+
     def expand_ident(self, namespace, ident):
         """
         Expand an identifier like 'foo' to:
                                    foo.main
                          namespace.foo
         depending on foo is a valid namespace or not. 
+        The results are stored as interned strings for fast lookups.
         """
+        key = (namespace, ident)
+        if key in self.dIdents:
+            return self.dIdents[key]
+        label = None
         pieces = ident.split(".")
         if len(pieces) == 1:
-            if ident in self.lNameSpaces:
-                return ident + ".start"
+            if ident in self.dNameSpaces:
+                label = ident + ".start"
             else:
-                return namespace + "." + ident
-            ident
+                label = namespace + "." + ident
         elif len(pieces) == 2:
-            if pieces[0] in self.lNameSpaces:
-                return ident
-        return None
+            if pieces[0] in self.dNameSpaces:
+                label = ident
+        if label:
+            label = sys.intern(label)
+        self.dIdents[key] = label
+        return label
+    
+    def namespace_of(self, filename):
+        if filename not in self.dFileSpaces:
+            self.dFileSpaces[filename] = sys.intern(os.path.splitext(filename)[0])
+        return self.dFileSpaces[filename]
+    
+    def get_alias(self, label):
+        val = self.dAliases.get(label)
+        if self.dSeg is not None and label not in self.dSeg["aliases"]:
+            self.dSeg["alias_reads"].setdefault(label, val)
+        return val
+    
+    def get_symbol(self, label):
+        val = self.dSymbols.get(label)
+        if self.dSeg is not None and label not in self.dSeg["symbols"]:
+            self.dSeg["symbol_reads"].setdefault(label, val)
+        return val
+    
+    def set_alias(self, label, val):
+        self.dAliases[label] = val
+        if self.dSeg is not None:
+            self.dSeg["aliases"][label] = val
+    
+    def set_symbol(self, label, val):
+        self.dSymbols[label] = val
+        if self.dSeg is not None:
+            self.dSeg["symbols"][label] = val
+    
+    def add_definition(self, label, addr):
+        site = (self.token[FILENAME], self.token[LINENUM], addr)
+        self.dXRef.setdefault(label, {"def": None, "uses": set()})["def"] = site
+        if self.dSeg is not None:
+            self.dSeg["defs"][label] = site
+    
+    def add_use(self, label):
+        addr = self.token[ADDRESS] if self.ispass2 else self.addr
+        site = (self.token[FILENAME], self.token[LINENUM], addr)
+        self.dXRef.setdefault(label, {"def": None, "uses": set()})["uses"].add(site)
+        if self.dSeg is not None:
+            self.dSeg["uses"].setdefault(label, set()).add(site)
+    
+    def add_cond_uses(self, lUses):
+        """
+        Add the alias uses in conditions (see Tokenizer) to the cross reference
+        """
+        for label, site in lUses:
+            self.dXRef.setdefault(label, {"def": None, "uses": set()})["uses"].add(site)
+    
+    def start_segment(self, lSeg):
+        """
+        Start recording the symbol/alias lookups and definitions of a token
+        list segment (watch mode)
+        """
+        self.dSeg = {"input": lSeg, "alias_reads": {}, "symbol_reads": {},
+                     "aliases": {}, "symbols": {}, "defs": {}, "uses": {}}
+        return self.dSeg
+    
+    def end_segment(self):
+        """
+        Stop recording and store the lookups as key and value lists
+        for a fast check in 'reusable'
+        """
+        seg, self.dSeg = self.dSeg, None
+        dAReads, dSReads = seg.pop("alias_reads"), seg.pop("symbol_reads")
+        seg["lookups"] = (tuple(dAReads), list(dAReads.values()),
+                          tuple(dSReads), list(dSReads.values()))
+    
+    def reusable(self, seg):
+        """
+        Check the lookups of a segment from the previous run against
+        the current symbol and alias tables
+        """
+        akeys, avals, skeys, svals = seg["lookups"]
+        return list(map(self.dAliases.get, akeys)) == avals and \
+               list(map(self.dSymbols.get, skeys)) == svals
+    
+    def reuse(self, seg):
+        """
+        Apply the definitions of a reused segment
+        """
+        self.dAliases.update(seg["aliases"])
+        self.dSymbols.update(seg["symbols"])
+        # the cross reference is only needed for the .xrf file
+        if "--xref" not in sys.argv:
+            return
+        for label, site in seg["defs"].items():
+            self.dXRef.setdefault(label, {"def": None, "uses": set()})["def"] = site
+        for label, lSites in seg["uses"].items():
+            self.dXRef.setdefault(label, {"def": None, "uses": set()})["uses"].update(lSites)
     
     def add_aliase(self, left_val, right_val):
+        name = left_val
         left_val = self.expand_ident(self.namespace, left_val)
         if left_val:
-            self.dAliases[left_val] = right_val
+            # command line defines override the source
+            if name not in self.dDefines:
+                right_val = join_expression(right_val.strip())
+                if is_expression(right_val):
+                    right_val = self.fold_expression(right_val)
+                self.set_alias(left_val, right_val)
+            self.add_definition(left_val, None)
         else:
             self.error("Inv. left value in '%s'" % self.line)
 
     def add_symbol(self, label, addr):
         label2 = self.expand_ident(self.namespace, label)
+        if label2 in self.lPooled:
+            return
         if label2:
-            if label != "start" and label2 in self.dSymbols:
+            if label != "start" and self.get_symbol(label2) is not None:
                 self.error("Label '%s' used twice in\n'%s'" % (label, self.line))
-            self.dSymbols[label2] = addr
+            self.set_symbol(label2, addr)
+            self.add_definition(label2, addr)
         else:
             self.error("Inv. label value in '%s'" % self.line)
             
@@ -307,28 +886,22 @@ class AsmBase(object):
         words = line.split()
         if words[0] == ".code":
             label = self.namespace + ".start"
-            if label not in self.dSymbols:
-                self.dSymbols[label] = addr
-            
-    def get_symbol_addr(self, label):
-        label2 = self.expand_ident(self.namespace, label)
-        if label2 in self.dSymbols:
-            return self.dSymbols[label2]
-        if self.ispass2:
-            self.error("Invalid oprnd in '%s'" % self.line)
-        return 0
+            if self.get_symbol(label) is None:
+                self.set_symbol(label, addr)
             
     def aliases(self, s):    
-        namespace = os.path.splitext(self.token[FILENAME])[0]
-        
         if s[0] == "#":
-            ident = self.expand_ident(namespace, s[1:])
-            if ident in self.dAliases:
-                return "#" + self.dAliases[ident]
+            ident = self.expand_ident(self.namespace, s[1:])
+            val = self.get_alias(ident)
+            if val is not None:
+                self.add_use(ident)
+                return "#" + val
         else:
-            ident = self.expand_ident(namespace, s)
-            if ident in self.dAliases:
-                return self.dAliases[ident]
+            ident = self.expand_ident(self.namespace, s)
+            val = self.get_alias(ident)
+            if val is not None:
+                self.add_use(ident)
+                return val
         return s
 
 
@@ -341,12 +914,22 @@ class AsmPass1(AsmBase):
     - return the enriched token list (file-ref, line-no, line-string, line-type, 
                                       address, instr-size, instr-words)
     """
-    def __init__(self, lNameSpaces):
+    def __init__(self, lNameSpaces, lPooled=None, dDefines=None):
         AsmBase.__init__(self, lNameSpaces)
+        self.lPooled = lPooled or []  # labels of pooled strings, located later
+        self.lOrgs = []         # token indexes of the .org directives
+        self.token_idx = 0
         self.segment_type = CODETYPE
         self.addr = 0
         self.dSymbols = {}
         self.dAliases = {}
+        self.dDefines = dDefines or {}
+        # command line defines are aliases in all name spaces
+        for name, val in self.dDefines.items():
+            for namespace in lNameSpaces:
+                label = self.expand_ident(namespace, name)
+                if label:
+                    self.dAliases[label] = join_expression(val)
         self.prepare_opcode_tables()
 
     def directive(self, s):
@@ -365,6 +948,7 @@ class AsmPass1(AsmBase):
             return True
         elif words[0] == ".org" and len(words) > 1:
             self.addr = self.value(words[1])
+            self.lOrgs.append(self.token_idx)
             return True
         return False
 
@@ -402,7 +986,7 @@ class AsmPass1(AsmBase):
         list_get = lambda l, idx: l[idx] if len(l) > idx else None
             
         line = self.token[LINESTR]
-        self.namespace = os.path.splitext(self.token[FILENAME])[0]
+        self.namespace = self.namespace_of(self.token[FILENAME])
         line = line.split(";")[0].rstrip()
         self.line = line.strip() # for error messages
         line = line.replace(",", " ")
@@ -410,7 +994,7 @@ class AsmPass1(AsmBase):
         line = line.strip()
         if line == "": 
             return self.comment()
-        words = line.split()
+        words = join_expression(line).split()
         # assembler directive
         if self.directive(line):
             self.add_default_label(line, self.addr)
@@ -439,7 +1023,9 @@ class AsmPass1(AsmBase):
         if self.segment_type == DATATYPE:
             l = []
             for s in words:
-                l.append(self.value(s))
+                val = self.expression(s)
+                # labels not yet known are evaluated in pass 2
+                l.append(s if val is None else val)
             return self.tokenize(len(l), l)
         # code segment
         if words[0] not in self.dOpcodes:
@@ -454,14 +1040,53 @@ class AsmPass1(AsmBase):
                 self.error("Invalid syntax in '%s'\n(number of words > 2)" % self.line)
         return self.tokenize(size, words)    
 
-    def run(self, lToken):
+    def run(self, lToken, base=0):
         lNewToken = []
-        for self.token in lToken:
+        for self.token_idx, self.token in enumerate(lToken, base):
             token = self.decode()
             if token:
                 lNewToken.append(token)
         return lNewToken
 
+    def run_segments(self, lSegments, dOldSegs, dSegs):
+        """
+        Like 'run', but per token list segment of the tokenizer (watch mode).
+        The results of a segment from the previous run (dOldSegs) are reused,
+        if the start address and all symbol lookups are unchanged.
+        As long as the segments have the same definitions as in the previous
+        run, the symbol and alias tables are the same, and the lookups need
+        not be checked.
+        All segment results are stored in 'dSegs'.
+        Returns the token list and the list of the output segments.
+        """
+        lNewToken = []
+        lOutSegs = []
+        lOldSegs = list(dOldSegs.values())  # in the order of the previous run
+        same = True
+        for pos, lSeg in enumerate(lSegments):
+            start = (self.addr, self.segment_type)
+            old = lOldSegs[pos] if same and pos < len(lOldSegs) else None
+            seg = dOldSegs.get(id(lSeg))
+            if seg and seg["input"] is lSeg and seg["start"] == start and \
+                    (seg is old or self.reusable(seg)):
+                self.reuse(seg)
+                self.lOrgs.extend([len(lNewToken) + idx for idx in seg["orgs"]])
+                self.addr, self.segment_type = seg["end"]
+            else:
+                num_orgs = len(self.lOrgs)
+                seg = self.start_segment(lSeg)
+                seg["tokens"] = self.run(lSeg, len(lNewToken))
+                seg["orgs"] = [idx - len(lNewToken) for idx in self.lOrgs[num_orgs:]]
+                seg["start"] = start
+                seg["end"] = (self.addr, self.segment_type)
+                self.end_segment()
+            same = old is not None and (seg is old or (seg["end"] == old["end"] and
+                   seg["symbols"] == old["symbols"] and seg["aliases"] == old["aliases"]))
+            dSegs[id(lSeg)] = seg
+            lNewToken.extend(seg["tokens"])
+            lOutSegs.append(seg["tokens"])
+        return lNewToken, lOutSegs
+
 class AsmPass2(AsmBase):
     """
     Work on the given token list:
@@ -469,8 +1094,8 @@ class AsmPass2(AsmBase):
     - return the enriched token list (file-ref, line-no, line-string, line-type, 
                                       address, instr-size, instr-words, opcodes)
     """
-    def __init__(self, lNameSpaces, dSymbols, dAliases):
-        AsmBase.__init__(self, lNameSpaces)
+    def __init__(self, lNameSpaces, dSymbols, dAliases, dXRef=None):
+        AsmBase.__init__(self, lNameSpaces, dXRef)
         self.ispass2 = True
         self.dSymbols = dSymbols
         self.dAliases = dAliases
@@ -509,13 +1134,15 @@ class AsmPass2(AsmBase):
             return Operands.index("REL"), offset
         m = reSTACK.match(s)
         if m: return Operands.index("[SP+n]"), self.value(m.group(1))
-        if s[0] == "#": return Operands.index("IMM"), self.get_symbol_addr(s[1:]) 
+        if s[0] == "#": return Operands.index("IMM"), self.expression(s[1:]) 
         if s[0] in ["+", "-"]:
-            dst_addr = self.get_symbol_addr(s[1:])
+            dst_addr = self.expression(s[1:])
             src_addr = self.token[ADDRESS]  
             offset = (0x10000 + dst_addr - src_addr - 2) & 0xFFFF
             return Operands.index("REL"), offset
-        return Operands.index("IND"), self.get_symbol_addr(s) 
+        if s[0:4] == "[SP+" and s[-1] == "]":
+            return Operands.index("[SP+n]"), self.expression(s[4:-1])
+        return Operands.index("IND"), self.expression(s) 
         
     def get_opcode(self, instr):
         if instr not in self.dOpcodes:
@@ -535,7 +1162,7 @@ class AsmPass2(AsmBase):
 
     def decode(self):
         line = self.token[LINESTR]
-        self.namespace = os.path.splitext(self.token[FILENAME])[0]
+        self.namespace = self.namespace_of(self.token[FILENAME])
         self.line = line.split(";")[0].strip() # for error messages
         list_get = lambda l, idx: l[idx] if len(l) > idx else None
         instr = list_get(self.token[INSTRWORDS], 0)
@@ -559,26 +1186,126 @@ class AsmPass2(AsmBase):
              self.error("Internal error '%s'" % repr(self.token))
         return self.tokenize(code)
     
+    def data(self):
+        self.namespace = self.namespace_of(self.token[FILENAME])
+        self.line = self.token[LINESTR].split(";")[0].strip() # for error messages
+        code = []
+        for val in self.token[INSTRWORDS]:
+            if isinstance(val, str):
+                val = self.expression(val)
+            code.append(val)
+        return self.tokenize(code)
+
     def run(self, lToken):
         lNewToken = []
         for self.token in lToken:
             if self.token[LINETYPE] == CODETYPE:
                 token = self.decode()
+            elif self.token[LINETYPE] == DATATYPE:
+                token = self.data()
             else:
                 token = self.tokenize(self.token[INSTRWORDS])
             lNewToken.append(token)
         return lNewToken
 
+    def run_segments(self, lSegments, dOldSegs, dSegs, same=False):
+        """
+        Like 'run', but per pass 1 output segment (watch mode).
+        The encodings of a segment from the previous run (dOldSegs) are reused,
+        if the segment (with its addresses) and all symbol lookups are unchanged.
+        The lookups need not be checked, if the symbol and alias tables are
+        the same as in the previous run ('same').
+        Returns the token list and the list of the output segments.
+        """
+        lNewToken = []
+        lOutSegs = []
+        for lSeg in lSegments:
+            seg = dOldSegs.get(id(lSeg))
+            if seg and seg["input"] is lSeg and (same or self.reusable(seg)):
+                self.reuse(seg)
+            else:
+                seg = self.start_segment(lSeg)
+                seg["tokens"] = self.run(lSeg)
+                self.end_segment()
+            dSegs[id(lSeg)] = seg
+            lNewToken.extend(seg["tokens"])
+            lOutSegs.append(seg["tokens"])
+        return lNewToken, lOutSegs
+
+def string_pool(lToken, lPass1Token, dSymbols):
+    """
+    Find labeled .text/.ctext strings, which are identical to other strings or
+    which are zero-terminated suffixes of other strings.
+    'lToken' is the tokenizer output, 'lPass1Token' the related pass 1 output.
+    Return the token list without the pooled strings, a dict with
+    {label: (target-label, offset)}, and the number of saved words.
+    """
+    dLabels = {}
+    for label, addr in dSymbols.items():
+        dLabels.setdefault(addr, []).append(label)
+
+    # collect runs of consecutive text tokens, starting with a label
+    lRuns = []
+    run = None
+    for idx, token in enumerate(lPass1Token):
+        if token[LINETYPE] in [WTEXTTYPE, BTEXTTYPE] and token[INSTRSIZE] > 0:
+            addr = token[ADDRESS]
+            if addr in dLabels:
+                run = {"labels": sorted(dLabels[addr]), "indices": [], "words": [],
+                       "end": addr, "type": token[LINETYPE]}
+                lRuns.append(run)
+            elif run is None or run["end"] != addr:
+                run = None
+                continue
+            run["indices"].append(idx)
+            run["words"].extend(token[INSTRWORDS])
+            run["end"] = addr + token[INSTRSIZE]
+            run["type"] = token[LINETYPE]
+        elif token[LINETYPE] != COMMENT:
+            run = None
+
+    def terminated(run):
+        if run["type"] == BTEXTTYPE:
+            return run["words"][-1] & 0xFF == 0
+        return run["words"][-1] == 0
+
+    dExact = {}
+    dSuffix = {}
+    dPooled = {}
+    lRemove = set()
+    saved = 0
+    for run in sorted(lRuns, key=lambda r: -len(r["words"])):
+        key = tuple(run["words"])
+        # only zero-terminated strings, a run without a terminating zero
+        # is continued by the next labeled string
+        if key in dExact and terminated(run):
+            target, offs = dExact[key], 0
+        elif key in dSuffix and terminated(run):
+            target, offs = dSuffix[key]
+        else:
+            dExact.setdefault(key, run)
+            for i in range(1, len(key)):
+                dSuffix.setdefault(key[i:], (run, i))
+            continue
+        for label in run["labels"]:
+            dPooled[label] = (target["labels"][0], offs)
+        lRemove.update(run["indices"])
+        saved += len(key)
+    lToken = [t for idx, t in enumerate(lToken) if idx not in lRemove]
+    return lToken, dPooled, saved
+
 def locater(lToken):
     """
     Memory allocation of the token list code.
     Returns start-address, the array with the opcodes, and the last used address
     (unused memory cells are set to -1) 
     """
-    l = copy(lToken)
-    l.sort(key=lambda item: item[ADDRESS])
-    start = list(filter(lambda t: t[LINETYPE] < COMMENT, l))[0][ADDRESS]
-    end   = l[-1][ADDRESS] + l[-1][INSTRSIZE]
+    lCode = [t for t in lToken if t[LINETYPE] < COMMENT]
+    if not lCode:
+        outp("Error: No code to locate!")
+        sys.exit(-1)
+    start = min([t[ADDRESS] for t in lCode])
+    end   = max([t[ADDRESS] + t[INSTRSIZE] for t in lCode])
     size = end - start
     mem = array('l', [-1] * size)
 
@@ -599,10 +1326,222 @@ def locater(lToken):
                 if mem[addr + idx] != -1: outp("Warning: Mem. loc. conflict at $%04X" % (addr + idx))
                 mem[addr + idx] = val
     return start, mem, end-1
+
+def locate(lToken, dCache=None):
+    """
+    Like 'locater', but in watch mode only the memory cells of the changed
+    token list segments (dCache["segments"], see 'assemble') are updated
+    in the memory image of the previous build, if the changed segments
+    use the same addresses as the replaced ones.
+    """
+    def footprint(lSegments):
+        return sorted([(t[ADDRESS], t[INSTRSIZE], len(t[OPCODES]))
+                       for lSeg in lSegments for t in lSeg if t[LINETYPE] < COMMENT])
     
-def list_file(path, fname, lToken):
+    if dCache is None or dCache.get("segments") is None:
+        if dCache is not None:
+            dCache.pop("located", None)
+        return locater(lToken)
+    lSegments = dCache["segments"]
+    if "located" in dCache:
+        lOldSegments, start, mem, end = dCache["located"]
+        dOld = dict([(id(l), l) for l in lOldSegments])
+        dNew = dict([(id(l), l) for l in lSegments])
+        lAdded = [l for l in lSegments if dOld.get(id(l)) is not l]
+        lRemoved = [l for l in lOldSegments if dNew.get(id(l)) is not l]
+        if footprint(lAdded) == footprint(lRemoved):
+            mem = array('l', mem)
+            for lSeg in lAdded:
+                for token in lSeg:
+                    if token[LINETYPE] < COMMENT and token[OPCODES]:
+                        addr = token[ADDRESS] - start
+                        mem[addr:addr + len(token[OPCODES])] = array('l', token[OPCODES])
+            dCache["located"] = (lSegments, start, mem, end)
+            return start, mem, end
+    start, mem, end = locater(lToken)
+    # patching is only possible without memory location conflicts
+    words = sum([len(t[OPCODES]) for t in lToken if t[LINETYPE] < COMMENT])
+    if len(mem) - mem.count(-1) == words:
+        dCache["located"] = (lSegments, start, mem, end)
+    else:
+        dCache.pop("located", None)
+    return start, mem, end
+    
+def split_images(lToken, lOrgs, by_segment=False):
+    """
+    Split the token list into several memory images, one per .org region
+    (overlapping regions are combined), optionally split further into
+    one image per segment type (code, text, data).
+    Returns a list of (name, token-list) tuples, sorted by address.
+    """
+    lRegions = []
+    for start, end in zip([0] + lOrgs, lOrgs + [len(lToken)]):
+        l = [t for t in lToken[start:end] if t[LINETYPE] < COMMENT and t[INSTRSIZE] > 0]
+        if l:
+            first = min([t[ADDRESS] for t in l])
+            last = max([t[ADDRESS] + t[INSTRSIZE] for t in l])
+            lRegions.append([first, last, l])
+    lRegions.sort(key=lambda item: item[0])
+    lMerged = []
+    for region in lRegions:
+        if lMerged and region[0] < lMerged[-1][1]:
+            lMerged[-1][1] = max(lMerged[-1][1], region[1])
+            lMerged[-1][2].extend(region[2])
+        else:
+            lMerged.append(region)
+    # keep the source order, so that memory conflicts are resolved like with one image
+    dOrder = dict([(id(t), idx) for idx, t in enumerate(lToken)])
+    for region in lMerged:
+        region[2].sort(key=lambda t: dOrder[id(t)])
+    if not by_segment:
+        return [("%04X" % first, l) for first, last, l in lMerged]
+
+    lImages = []
+    for first, last, lRegion in lMerged:
+        for name, lTypes in [("code", [CODETYPE]), ("text", [WTEXTTYPE, BTEXTTYPE]),
+                             ("data", [DATATYPE])]:
+            l = [t for t in lRegion if t[LINETYPE] in lTypes]
+            if l:
+                first = min([t[ADDRESS] for t in l])
+                lImages.append(("%s_%04X" % (name, first), l))
+    lImages.sort(key=lambda item: min([t[ADDRESS] for t in item[1]]))
+    return lImages
+
+def image_files(path, fname, lToken, lOrgs, by_segment=False):
+    """
+    Generate one H16 file (or binary image file with '--com') per memory
+    image and a manifest file with the address ranges of all images.
+    Returns the number of used words.
+    """
+    import json
+    import hashlib
+    basename = os.path.splitext(fname)[0]
+    lManifest = []
+    size = 0
+    for name, l in split_images(lToken, lOrgs, by_segment):
+        start_addr, mem, last_addr = locater(l)
+        imgname = "%s_%s" % (basename, name)
+        if "--com" in sys.argv:
+            used = img_file(path, imgname, mem)
+            ext = ".img"
+        else:
+            used = h16_file(path, imgname, start_addr, last_addr, mem)
+            ext = ".h16"
+        data = array('H', [v if v != -1 else 0 for v in mem]).tobytes()
+        lManifest.append({"name": name, "file": imgname + ext,
+                          "start": start_addr, "end": last_addr, "size": used,
+                          "hash": hashlib.sha1(data).hexdigest()})
+        size += used
+    mname = basename + ".images.json"
+    outp(" - write %s..." % mname)
+    write_file(path, mname, json.dumps(lManifest, indent=2))
+    return size
+
+def instr_cost(token):
+    """
+    Return number of words and cycles of a code token
+    """
+    instr = Opcodes[token[OPCODES][0] >> 10].split(":")[0]
+    size = len(token[OPCODES])
+    return size, Cycles[instr] + size - 1
+
+def branch_target(token):
+    """
+    Return the destination address of a jump/branch instruction
+    or None for all other instructions.
+    """
+    code = token[OPCODES]
+    instr = Opcodes[code[0] >> 10].split(":")[0]
+    if instr not in JumpInst or instr == "call":
+        return None
+    opnd1 = Operands[(code[0] >> 5) & 0x1F]
+    opnd2 = Operands[code[0] & 0x1F]
+    if instr == "jump":
+        opnd, idx = opnd1, 1
+    else:
+        opnd = opnd2
+        idx = 2 if opnd1 in ["IMM", "IND", "REL", "[SP+n]"] else 1
+    if opnd == "IMM":
+        return code[idx]
+    if opnd == "REL":
+        return (token[ADDRESS] + code[idx] + 2) & 0xFFFF
+    return None
+
+def profile(lToken, dSymbols):
+    """
+    Static profile of the code per label with code size, straight-line
+    cycle costs, and loops (backward branches and dbnz).
+    Labels with the same address are combined.
+    Returns a list of dicts, sorted by address.
+    """
+    from bisect import bisect_left
+    lCode = sorted([t for t in lToken if t[LINETYPE] == CODETYPE], key=lambda t: t[ADDRESS])
+    lCodeAddr = [t[ADDRESS] for t in lCode]
+    lCost = [instr_cost(t) for t in lCode]
+    # prefix sum of the cycles for the loop bodies
+    lCycleSum = [0]
+    for words, cyc in lCost:
+        lCycleSum.append(lCycleSum[-1] + cyc)
+    dLabels = {}
+    for label, addr in dSymbols.items():
+        dLabels.setdefault(addr, []).append(label)
+    lAddr = sorted(dLabels.keys())
+    lItems = []
+    pos = 0
+    for idx, addr in enumerate(lAddr):
+        end = lAddr[idx + 1] if idx + 1 < len(lAddr) else 0x10000
+        while pos < len(lCode) and lCodeAddr[pos] < addr:
+            pos += 1
+        if pos == len(lCode) or lCodeAddr[pos] >= end:
+            continue
+        size = 0
+        cycles = 0
+        lLoops = []
+        while pos < len(lCode) and lCodeAddr[pos] < end:
+            token = lCode[pos]
+            words, cyc = lCost[pos]
+            size += words
+            cycles += cyc
+            dst = branch_target(token)
+            if dst is not None and dst <= token[ADDRESS]:
+                last = token[ADDRESS] + token[INSTRSIZE]
+                first = bisect_left(lCodeAddr, dst)
+                stop = bisect_left(lCodeAddr, last)
+                lLoops.append({
+                    "start": dst, "end": last - 1,
+                    "cycles": lCycleSum[stop] - lCycleSum[first],
+                    "dbnz": Opcodes[token[OPCODES][0] >> 10].startswith("dbnz:"),
+                })
+            pos += 1
+        lItems.append({"labels": sorted(dLabels[addr]), "address": addr, "size": size,
+                       "cycles": cycles, "loops": lLoops})
+    return lItems
+
+def profile_file(path, fname, lItems):
+    """
+    Generate a JSON file with the static profile
+    """
+    import json
+    fname = os.path.splitext(fname)[0] + ".prof.json"
+    outp(" - write %s..." % fname)
+    write_file(path, fname, json.dumps(lItems, indent=2))
+
+def profile_table(lItems):
+    outp("\nProfile:")
+    outp("   %-24s   ADDR  SIZE  CYCLES  LOOPS" % "LABEL")
+    for item in lItems:
+        loops = ", ".join(["%04X-%04X:%u%s" % (l["start"], l["end"], l["cycles"],
+                           " (dbnz)" if l["dbnz"] else "") for l in item["loops"]])
+        outp(" - %-24s = %04X  %4u  %6u  %s" % (item["labels"][0], item["address"],
+             item["size"], item["cycles"], loops))
+
+def list_file(path, fname, lToken, prof=False, lSegments=None, dLines=None):
     """
     Generate a list file
+    (with the columns number of words and cycles, if 'prof' is set).
+    In watch mode, the lines are generated per token list segment and
+    'dLines' holds the lines per segment of the previous build
+    {id(segment): (segment, lines)} and is updated.
     """
     from time import localtime, strftime
     fname = os.path.splitext(fname)[0] + ".lst"
@@ -611,28 +1550,51 @@ def list_file(path, fname, lToken):
     lOut = []
     lOut.append("VM16ASM v%s  %s  %s" % (VERSION, fname, t))
     lOut.append("")
-    for token in lToken:
-        if token[LINETYPE] == COMMENT:
-            cmnt = "%s" % token[LINESTR].rstrip()
-            lOut.append("%s" % cmnt)
-        elif token[LINETYPE] == CODETYPE:
-            addr = "%04X" % token[ADDRESS]
-            code = ", ".join(["%04X" % c for c in token[OPCODES]])
-            cmnt = "%s" % token[LINESTR].strip()
+    if prof:
+        lOut.append("ADDR  CODE          W CYC")
+    dOldLines = dLines or {}
+    dNewLines = {}
+    for lSeg in lSegments or [lToken]:
+        item = dOldLines.get(id(lSeg))
+        if not item or item[0] is not lSeg:
+            item = (lSeg, [line for token in lSeg for line in list_lines(token, prof)])
+        lOut.extend(item[1])
+        dNewLines[id(lSeg)] = item
+    if dLines is not None:
+        dLines.clear()
+        dLines.update(dNewLines)
+    write_file(path, fname, "\n".join(lOut))
+
+def list_lines(token, prof):
+    """
+    Return the list file lines of one token
+    """
+    lOut = []
+    if token[LINETYPE] == COMMENT:
+        cmnt = "%s" % token[LINESTR].rstrip()
+        lOut.append("%s" % cmnt)
+    elif token[LINETYPE] == CODETYPE:
+        addr = "%04X" % token[ADDRESS]
+        code = ", ".join(["%04X" % c for c in token[OPCODES]])
+        cmnt = "%s" % token[LINESTR].strip()
+        if prof:
+            words, cycles = instr_cost(token)
+            lOut.append("%s: %-12s %u %3u  %s" % (addr, code, words, cycles, cmnt))
+        else:
             lOut.append("%s: %-12s  %s" % (addr, code, cmnt))
-        elif token[LINETYPE] in [BTEXTTYPE, WTEXTTYPE]:
-            addr = "%04X" % token[ADDRESS]
-            code = ", ".join(["%04X" % c for c in token[OPCODES]])
-            cmnt = "%s" % token[LINESTR].rstrip()
-            lOut.append("%s" % cmnt)
-            lOut.append("%s: %s" % (addr, code))
-        elif token[LINETYPE] == DATATYPE:
-            addr = "%04X" % token[ADDRESS]
-            code = ", ".join(["%04X" % c for c in token[OPCODES]])
-            cmnt = "%s" % token[LINESTR].rstrip()
-            lOut.append("%s" % cmnt)
-            lOut.append("%s: %s" % (addr, code))
-    open(path + fname, "wt").write("\n".join(lOut))
+    elif token[LINETYPE] in [BTEXTTYPE, WTEXTTYPE]:
+        addr = "%04X" % token[ADDRESS]
+        code = ", ".join(["%04X" % c for c in token[OPCODES]])
+        cmnt = "%s" % token[LINESTR].rstrip()
+        lOut.append("%s" % cmnt)
+        lOut.append("%s: %s" % (addr, code))
+    elif token[LINETYPE] == DATATYPE:
+        addr = "%04X" % token[ADDRESS]
+        code = ", ".join(["%04X" % c for c in token[OPCODES]])
+        cmnt = "%s" % token[LINESTR].rstrip()
+        lOut.append("%s" % cmnt)
+        lOut.append("%s: %s" % (addr, code))
+    return lOut
     
 def bin_file(path, fname, mem, fillword=0):
     """
@@ -645,7 +1607,7 @@ def bin_file(path, fname, mem, fillword=0):
         lOut.append("%04X" % (v if v != -1 else 0))
         if idx > 0 and idx % 8 == 0:
             lOut[-1] = "\n" + lOut[-1]
-    open(path + fname, "wt").write(" ".join(lOut))
+    write_file(path, fname, " ".join(lOut))
     
 def tbl_file(path, fname, mem, fillword=0):
     """
@@ -658,7 +1620,7 @@ def tbl_file(path, fname, mem, fillword=0):
         lOut.append("0x%04X" % (v if v != -1 else 0))
         if idx > 0 and idx % 8 == 0:
             lOut[-1] = "\n" + lOut[-1]
-    open(path + fname, "wt").write(", ".join(lOut))
+    write_file(path, fname, ", ".join(lOut))
     
 def com_file(path, fname, start_addr, mem):
     """
@@ -668,15 +1630,32 @@ def com_file(path, fname, start_addr, mem):
         fname = os.path.splitext(fname)[0] + ".com"
         outp(" - write %s..." % fname)
         size = len(mem)
-        s = struct.pack("<" + size*'H', *mem)
-        open(path + fname, "wb").write(s)
+        arr = array('H', [v if v != -1 else 0 for v in mem])
+        if sys.byteorder == "big":
+            arr.byteswap()
+        write_file(path, fname, arr.tobytes())
         return size
     outp("Error: Start address must be $100 (hex)!")
     sys.exit(-1)
     
-def h16_file(path, fname, start_addr, last_addr, mem):
+def img_file(path, fname, mem):
     """
-    Generate a H16 file for import into Minetest 
+    Generate a binary memory image file (unused cells are set to zero).
+    Returns the number of used words.
+    """
+    fname = os.path.splitext(fname)[0] + ".img"
+    outp(" - write %s..." % fname)
+    arr = array('H', [v if v != -1 else 0 for v in mem])
+    if sys.byteorder == "big":
+        arr.byteswap()
+    write_file(path, fname, arr.tobytes())
+    return len([v for v in mem if v != -1])
+
+def h16_file(path, fname, start_addr, last_addr, mem, dBlocks=None):
+    """
+    Generate a H16 file for import into Minetest.
+    In watch mode, 'dBlocks' holds the memory image and the lines per
+    block of rows of the previous build and is updated.
     """
     def first_valid(arr, start):
         for idx, val in enumerate(arr[start:]):
@@ -696,26 +1675,94 @@ def h16_file(path, fname, start_addr, last_addr, mem):
     fname = os.path.splitext(fname)[0] + ".h16"
     outp(" - write %s..." % fname)
 
-    idx = 0
     ROWSIZE = 8
+    BLOCKSIZE = 64 * ROWSIZE
     lOut = []
     size = 0
     lOut.append(":2000001%04X%04X" % (start_addr, last_addr))
-    while idx < len(mem):
-        row = mem[idx:idx+ROWSIZE]
-        i1 = 0
-        offs = 0
-        while i1 < ROWSIZE and idx < len(mem):
-            i1 = first_valid(row, i1)
-            i2  = first_invalid(row, i1)
-            if i1 != i2 and i1 < ROWSIZE:
-                size += add(lOut, row[i1:i2], start_addr + idx + i1)
-                i1 = i2
-        idx += ROWSIZE
+    old_mem, lOldBlocks = None, []
+    if dBlocks and dBlocks["start"] == start_addr:
+        old_mem, lOldBlocks = dBlocks["mem"], dBlocks["blocks"]
+    lBlocks = []
+    for pos in range(0, len(mem), BLOCKSIZE):
+        block = mem[pos:pos+BLOCKSIZE]
+        if pos // BLOCKSIZE < len(lOldBlocks) and old_mem[pos:pos+BLOCKSIZE] == block:
+            lLines, num = lOldBlocks[pos // BLOCKSIZE]
+        else:
+            lLines, num = [], 0
+            for idx in range(0, len(block), ROWSIZE):
+                row = block[idx:idx+ROWSIZE]
+                i1 = 0
+                while i1 < ROWSIZE:
+                    i1 = first_valid(row, i1)
+                    i2  = first_invalid(row, i1)
+                    if i1 != i2 and i1 < ROWSIZE:
+                        num += add(lLines, row[i1:i2], start_addr + pos + idx + i1)
+                        i1 = i2
+        lBlocks.append((lLines, num))
+        lOut.extend(lLines)
+        size += num
+    if dBlocks is not None:
+        dBlocks.update({"start": start_addr, "mem": mem, "blocks": lBlocks})
     lOut.append(":00000FF")
-    open(path + fname, "wt").write("\n".join(lOut))
+    write_file(path, fname, "\n".join(lOut))
     return size
  
+def dbg_file(path, fname, lToken, dSymbols, start_addr, mem):
+    """
+    Generate a binary debug info file with address to source line mapping
+    """
+    from . import debuginfo
+    fname = os.path.splitext(fname)[0] + ".dbg"
+    outp(" - write %s..." % fname)
+    size = len(mem)
+    lFiles = []
+    dFileIds = {}
+    aLines = array('I', [debuginfo.UNUSED] * (size * 2))
+    aTypes = array('B', [0xFF] * size)
+    for token in lToken:
+        if token[LINETYPE] < COMMENT:
+            if token[FILENAME] not in dFileIds:
+                dFileIds[token[FILENAME]] = len(lFiles)
+                lFiles.append(token[FILENAME])
+            file_id = dFileIds[token[FILENAME]]
+            addr = token[ADDRESS] - start_addr
+            for idx in range(addr, addr + token[INSTRSIZE]):
+                aLines[idx * 2] = file_id
+                aLines[idx * 2 + 1] = token[LINENUM]
+                aTypes[idx] = token[LINETYPE]
+    write_file(path, fname, debuginfo.pack(start_addr, size, lFiles, aLines, aTypes, dSymbols))
+
+def unused_symbols(dXRef):
+    """
+    Return the sorted list of defined but unused symbols
+    (without the default 'start' labels)
+    """
+    return sorted([label for label, item in dXRef.items()
+                   if item["def"] and not item["uses"] and not label.endswith(".start")])
+
+def xref_file(path, fname, dXRef):
+    """
+    Generate a cross reference file with definition and uses of all symbols
+    """
+    fname = os.path.splitext(fname)[0] + ".xrf"
+    outp(" - write %s..." % fname)
+    site = lambda item: "%s(%u)%s" % (item[0], item[1], 
+                                      "" if item[2] is None else " $%04X" % item[2])
+    lOut = []
+    lOut.append("VM16ASM v%s  %s" % (VERSION, fname))
+    lOut.append("")
+    for label in sorted(dXRef.keys()):
+        item = dXRef[label]
+        lOut.append("%s: defined in %s" % (label, site(item["def"]) if item["def"] else "?"))
+        for use in sorted(item["uses"], key=lambda u: (u[0], u[1], u[2] or 0)):
+            lOut.append("    used in %s" % site(use))
+    lUnused = unused_symbols(dXRef)
+    lOut.append("")
+    lOut.append("Unused symbols: %s" % (", ".join(lUnused) or "-"))
+    write_file(path, fname, "\n".join(lOut) + "\n")
+    outp(" - %u symbols, %u unused" % (len(dXRef), len(lUnused)))
+
 def symbol_table(dSymbols):
     outp("\nSymbol table:")
     items = []
@@ -738,51 +1785,288 @@ def assembler():
     if "--srv" in sys.argv:
         DEST_PATH = sys.argv[2]
         fname = sys.argv[3]
+    elif "--snapshot" in sys.argv:
+        item = sys.argv[sys.argv.index("--snapshot") + 1]
+        DEST_PATH = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(item))) + "/"
+        fname = os.path.basename(item)
     else:
         DEST_PATH = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(sys.argv[1]))) + "/"
         fname = os.path.basename(sys.argv[1])
 
     outp("VM16 ASSEMBLER v%s (c) 2019-2021 by Joe\n" % VERSION, True)
+
+    if "--snapshot" in sys.argv:
+        outname = sys.argv[sys.argv.index("-o") + 1] if "-o" in sys.argv[:-1] else None
+        make_snapshot(fname, outname)
+    elif "--watch" in sys.argv:
+        watch(fname)
+    elif "--cache" in sys.argv:
+        key = cache_key(fname)
+        if not cache_restore(key):
+            build(fname)
+            cache_store(key)
+    else:
+        build(fname)
+    
+    if "--cache-stats" in sys.argv: cache_stats()
+    return 0
+
+def cache_key(fname):
+    from . import cache
+    lFiles = Tokenizer().include_files(DEST_PATH, fname)
+    lOptions = [s for s in sys.argv[1:] if s[0] == "-" and not s.startswith(("--cache", "-D"))]
+    lOptions += ["-D%s=%s" % item for item in sorted(defines().items())]
+    return cache.cache_key(fname, lFiles, lOptions)
+
+def cache_restore(key):
+    """
+    Write the output files from the build cache and replay the output.
+    Return False if not in the cache.
+    """
+    from . import cache
+    dEntry = cache.load(key)
+    if dEntry:
+        for fname, data in dEntry["files"].items():
+            write_file(DEST_PATH, fname, data)
+        for s in dEntry["log"]:
+            outp(s)
+        return True
+    return False
+
+def cache_store(key):
+    from . import cache
+    dFiles = {}
+    for fname in lOutputFiles:
+        dFiles[fname] = open(DEST_PATH + fname, "rb").read()
+    cache.store(key, dFiles, lOutputLog[1:])
+
+def cache_stats():
+    from . import cache
+    dStats = cache.stats()
+    outp("Build cache %s:" % dStats["path"])
+    outp(" - hits/misses: %u/%u" % (dStats["hits"], dStats["misses"]))
+    outp(" - entries: %u, size: %u/%u bytes\n" % (dStats["entries"], dStats["size"], dStats["limit"]))
+
+def make_snapshot(fname, outname):
+    """
+    Generate a snapshot file of the preprocessed library 'fname'
+    """
+    import time
+    from . import snapshot
+    t0 = time.perf_counter()
     outp(" - read %s..." % fname)
+    t = Tokenizer(None, defines())
+    lToken, lNameSpaces = t.load_file(DEST_PATH, fname, [])
+    # check the syntax
+    AsmPass1(lNameSpaces, [], t.dDefines).run(lToken)
+    if outname:
+        # '-o' is relative to the current directory
+        filename = os.path.realpath(os.path.join(os.getcwd(), outname))
+    else:
+        outname = os.path.splitext(fname)[0] + snapshot.EXT
+        filename = os.path.join(DEST_PATH, outname)
+    outp(" - write %s..." % outname)
+    size = snapshot.write(filename, lToken, lNameSpaces,
+                          t.lFiles, t.dMacros, t.dAliases, t.dDefines, t.lUses)
+    outp("Snapshot size: %u bytes (%.1f ms)\n" % (size, (time.perf_counter() - t0) * 1000))
+
+def watch(fname):
+    """
+    Rebuild on every change of the source files (until Ctrl-C).
+    The results of unchanged file parts and output files are reused.
+    """
+    import gc
+    import time
+    from .watch import Watcher
+    dCache = {}
+    lFiles = [os.path.realpath(DEST_PATH + fname)]
+    lFiles = watch_build(fname, dCache) or lFiles
+    watcher = Watcher()
+    outp(" - watch %u file(s) (%s), stop with Ctrl-C..." % (len(lFiles), watcher.name))
+    try:
+        while True:
+            lChanged = watcher.wait(lFiles)
+            t0 = time.perf_counter()
+            if not [f for f in lChanged if file_changed(f, dCache.get("lines", {}))]:
+                continue
+            outp("VM16 ASSEMBLER v%s (c) 2019-2021 by Joe\n" % VERSION, True)
+            # the garbage collection of the large cache is done after the build
+            gc.disable()
+            try:
+                lFiles = watch_build(fname, dCache) or lFiles
+            finally:
+                gc.enable()
+            outp("Rebuilt in %.1f ms\n" % ((time.perf_counter() - t0) * 1000))
+            gc.collect()
+    except KeyboardInterrupt:
+        pass
+
+def watch_build(fname, dCache):
+    """
+    Build without terminating the watch mode on errors.
+    Return the list of source files or None.
+    """
+    try:
+        return build(fname, dCache)
+    except SystemExit:
+        return None
+
+def file_changed(filename, dLines):
+    """
+    Compare the file with the cached file content
+    """
+    if filename not in dLines:
+        return True
+    try:
+        return open(filename).readlines() != dLines[filename]
+    except (OSError, ValueError):
+        return True
+
+def assemble(path, fname, dCache=None):
+    """
+    Tokenize and assemble the file 'fname'.
+    In watch mode, 'dCache' holds the file lines and the tokenizer, pass 1,
+    and pass 2 results per file part of the previous build. These are reused
+    for unchanged parts (pass 1 and 2 not with '--pool').
+    Returns the token list, the pass 2 assembler (with the symbol, alias and
+    cross reference tables), the .org token indexes, and the source files.
+    """
+    incremental = dCache is not None and "--pool" not in sys.argv
+    dCache = {} if dCache is None else dCache
     
-    t = Tokenizer()
-    lToken, lNameSpaces = t.load_file(DEST_PATH, fname)
+    t = Tokenizer(dCache.get("lines"), defines(), dCache.get("parts"))
+    lToken, lNameSpaces = t.load_file(path, fname, [])
+    dCache["lines"], dCache["parts"] = t.dLines, t.dParts
     #debug_out(lToken, {}, {})
     #sys.exit(0)
     
-    a = AsmPass1(lNameSpaces)
-    lToken = a.run(lToken)
-    #debug_out(lToken, a.dSymbols, a.dAliases)
+    a = AsmPass1(lNameSpaces, [], t.dDefines)
+    if incremental:
+        dPass1, dPass2 = {}, {}
+        lToken, lSegments = a.run_segments(t.lSegments, dCache.get("pass1", {}), dPass1)
+        lOrgs = a.lOrgs
+        same = dCache.get("tables") == (a.dSymbols, a.dAliases)
+        a = AsmPass2(lNameSpaces, a.dSymbols, a.dAliases, a.dXRef)
+        lToken, dCache["segments"] = a.run_segments(lSegments, dCache.get("pass2", {}), dPass2, same)
+        dCache["pass1"], dCache["pass2"] = dPass1, dPass2
+        dCache["tables"] = (a.dSymbols, a.dAliases)
+        a.add_cond_uses(t.lUses)
+        return lToken, a, lOrgs, t.lFiles
     
-    a = AsmPass2(lNameSpaces, a.dSymbols, a.dAliases)
+    dCache["segments"] = None
+    lPass1Token = a.run(lToken)
+    #debug_out(lPass1Token, a.dSymbols, a.dAliases)
+    
+    if "--pool" in sys.argv:
+        lToken, dPooled, saved = string_pool(lToken, lPass1Token, a.dSymbols)
+        if dPooled:
+            # determine the new addresses without the pooled strings
+            dXRef = a.dXRef
+            a = AsmPass1(lNameSpaces, dPooled, t.dDefines)
+            lPass1Token = a.run(lToken)
+            for label, (target, offs) in dPooled.items():
+                a.dSymbols[label] = a.dSymbols[target] + offs
+                # keep the definition, but with the relocated address
+                item = a.dXRef.setdefault(label, {"def": None, "uses": set()})
+                item["def"] = dXRef[label]["def"][:2] + (a.dSymbols[label],)
+        outp(" - string pool: %u words saved" % saved)
+    lToken = lPass1Token
+    lOrgs = a.lOrgs
+    
+    a = AsmPass2(lNameSpaces, a.dSymbols, a.dAliases, a.dXRef)
     lToken = a.run(lToken)
+    a.add_cond_uses(t.lUses)
+    return lToken, a, lOrgs, t.lFiles
+
+def output(dCache, name, value, func, *args):
+    """
+    Call the output function 'func' and return the result. In watch mode,
+    the call is skipped, if the output was generated from the same 'value'
+    by the previous build and the output files still exist.
+    """
+    if dCache is None:
+        return func(*args)
+    dOutputs = dCache.setdefault("outputs", {})
+    if name in dOutputs:
+        old_value, lFiles, result = dOutputs[name]
+        if old_value == value and all([os.path.exists(DEST_PATH + f) for f in lFiles]):
+            if lFiles:
+                outp(" - %s unchanged" % ", ".join(lFiles))
+            return result
+    num = len(lOutputFiles)
+    result = func(*args)
+    dOutputs[name] = (value, lOutputFiles[num:], result)
+    return result
+
+def build(fname, dCache=None):
+    """
+    Assemble the file 'fname' from DEST_PATH and write all output files.
+    In watch mode, 'dCache' holds the results of the previous build
+    (see 'assemble' and 'output').
+    Returns the list of all source files.
+    """
+    del lOutputFiles[:]
+    outp(" - read %s..." % fname)
+    
+    lToken, a, lOrgs, lFiles = assemble(DEST_PATH, fname, dCache)
+    # output lines of the previous build (watch mode)
+    lSegments, dLstLines, dH16Lines = None, None, None
+    if dCache is not None:
+        lSegments = dCache["segments"]
+        dLstLines = dCache.setdefault("lst", {})
+        dH16Lines = dCache.setdefault("h16", {})
 
     if "--lst" in sys.argv:
-        list_file(DEST_PATH, fname, lToken)
+        output(dCache, "lst", lToken, list_file, DEST_PATH, fname, lToken, "--prof" in sys.argv,
+               lSegments, dLstLines)
         
-    start_addr, mem, last_addr = locater(lToken)
+    start_addr, mem, last_addr = output(dCache, "mem", lToken, locate, lToken, dCache)
     
-    if "--com" in sys.argv:
-        size = com_file(DEST_PATH, fname, start_addr, mem)
+    if "--split-org" in sys.argv or "--split-seg" in sys.argv:
+        size = output(dCache, "image", (lToken, lOrgs), image_files, DEST_PATH, fname,
+                      lToken, lOrgs, "--split-seg" in sys.argv)
+    elif "--com" in sys.argv:
+        size = output(dCache, "image", (start_addr, mem), com_file, DEST_PATH, fname, start_addr, mem)
     else:
-        size = h16_file(DEST_PATH, fname, start_addr, last_addr, mem)
+        size = output(dCache, "image", (start_addr, mem), h16_file, DEST_PATH, fname,
+                      start_addr, last_addr, mem, dH16Lines)
     
-    if "--tbl" in sys.argv: tbl_file(DEST_PATH, fname, mem)
+    if "--tbl" in sys.argv: output(dCache, "tbl", mem, tbl_file, DEST_PATH, fname, mem)
+    if "--dbg" in sys.argv:
+        output(dCache, "dbg", (lToken, a.dSymbols), dbg_file, DEST_PATH, fname,
+               lToken, a.dSymbols, start_addr, mem)
     if "--sym" in sys.argv: symbol_table(a.dSymbols)
+    if "--xref" in sys.argv: output(dCache, "xref", a.dXRef, xref_file, DEST_PATH, fname, a.dXRef)
+    if "--prof" in sys.argv:
+        lItems = output(dCache, "prof", (lToken, a.dSymbols), profile, lToken, a.dSymbols)
+        output(dCache, "prof_file", lItems, profile_file, DEST_PATH, fname, lItems)
+        profile_table(lItems)
     
     outp("")
     outp("Code start address: $%04X" % start_addr)
     outp("Last used address:  $%04X" % last_addr)
     outp("Code size: $%04X/%u words\n" % (size, size))
-    return 0
+    return lFiles
 
 def main():
-    if len(sys.argv) < 2 or ("--srv" in sys.argv and len(sys.argv) < 4):
+    if len(sys.argv) < 2 or ("--srv" in sys.argv and len(sys.argv) < 4) or \
+            sys.argv[-1] == "--snapshot":
         outp("Syntax: vm16asm <asm-file> <options>")
+        outp("    or: vm16asm --snapshot <asm-file> [-o <v16s-file>]")
         outp("Options:")
         outp(" --com  Generate COM file (not H16)")
         outp(" --lst  Generate list file")
         outp(" --sym  Print symbol table entries")
+        outp(" --dbg  Generate binary debug info file")
+        outp(" --split-org  Generate one image per .org region (+ manifest)")
+        outp(" --split-seg  Generate one image per segment type (+ manifest)")
+        outp(" --xref Generate cross reference file")
+        outp(" --pool Pool identical strings and string suffixes")
+        outp(" --prof Generate a static profile (words/cycles per label)")
+        outp(" --cache Use the build cache ($VM16ASM_CACHE)")
+        outp(" --cache-stats Print build cache statistics")
+        outp(" --watch Rebuild on every change of the source files")
+        outp(" -D NAME=VAL  Define the symbol NAME (overrides the source)")
         outp("or:")
         outp(" -cls   Short for '--com --lst --sym'")
         
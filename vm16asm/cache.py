@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+# vm16asm - Macro Assembler for the VM16 CPU
+# Copyright (C) 2019-2021 Joe <iauit@gmx.de>
+#
+
+# v16asm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# v16asm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with v16asm.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Content-addressed build cache for whole assemblies.
+
+A cache entry is keyed by the hash of the assembler version, the command
+line options, and the contents of the root file with all its include files.
+It stores the generated output files and the assembler output lines.
+Entries are written atomically (temp file + rename), so that several
+processes can share one cache directory. If the cache exceeds the size
+limit, the least recently used entries are removed.
+
+Cache directory and size limit are taken from the environment variables
+VM16ASM_CACHE (default ~/.cache/vm16asm) and VM16ASM_CACHE_SIZE (in bytes,
+default 32 MB).
+"""
+
+import os
+import json
+import marshal
+import hashlib
+import tempfile
+from .instructions import VERSION
+
+ENTRY_EXT = ".v16c"
+STATS_FILE = "stats.json"
+DEFAULT_SIZE = 32 * 1024 * 1024
+
+def cache_dir():
+    path = os.environ.get("VM16ASM_CACHE") or \
+        os.path.join(os.path.expanduser("~"), ".cache", "vm16asm")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def cache_limit():
+    try:
+        return int(os.environ.get("VM16ASM_CACHE_SIZE", DEFAULT_SIZE))
+    except ValueError:
+        return DEFAULT_SIZE
+
+def cache_key(fname, lFiles, lOptions):
+    """
+    fname is the root file name, lFiles the list with (filename, content)
+    of all source files, and lOptions the list of command line options.
+    """
+    h = hashlib.sha256()
+    h.update(VERSION.encode())
+    h.update(("\0%s\0" % os.path.basename(fname)).encode())
+    h.update("\0".join(sorted(lOptions)).encode())
+    for filename, data in lFiles:
+        h.update(b"\0" + os.path.basename(filename).encode() + b"\0")
+        h.update(hashlib.sha256(data).digest())
+    return h.hexdigest()
+
+def write_atomic(path, data):
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmpname, path)
+    except OSError:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+def update_stats(hit):
+    """
+    Update the hit/miss counters (a lost update caused by concurrent
+    processes is accepted).
+    """
+    path = os.path.join(cache_dir(), STATS_FILE)
+    dStats = read_stats()
+    dStats["hits" if hit else "misses"] += 1
+    write_atomic(path, json.dumps(dStats).encode())
+
+def read_stats():
+    path = os.path.join(cache_dir(), STATS_FILE)
+    try:
+        dStats = json.loads(open(path).read())
+    except (OSError, ValueError):
+        dStats = {}
+    return {"hits": dStats.get("hits", 0), "misses": dStats.get("misses", 0)}
+
+def load(key):
+    """
+    Return the cache entry as dict {"files": {fname: data}, "log": [lines]}
+    or None.
+    """
+    path = os.path.join(cache_dir(), key + ENTRY_EXT)
+    try:
+        dEntry = marshal.loads(open(path, "rb").read())
+        os.utime(path)  # for LRU eviction
+    except (OSError, EOFError, ValueError, TypeError):
+        dEntry = None
+    if dEntry and dEntry.get("version") != VERSION:
+        dEntry = None
+    update_stats(dEntry is not None)
+    return dEntry
+
+def store(key, dFiles, lLog):
+    """
+    Store the generated files {fname: data} and the output lines
+    """
+    dEntry = {"version": VERSION, "files": dFiles, "log": lLog}
+    write_atomic(os.path.join(cache_dir(), key + ENTRY_EXT), marshal.dumps(dEntry))
+    evict(cache_limit())
+
+def entries():
+    """
+    Return a list with (mtime, size, path) of all cache entries
+    """
+    path = cache_dir()
+    lItems = []
+    for name in os.listdir(path):
+        if name.endswith(ENTRY_EXT):
+            try:
+                st = os.stat(os.path.join(path, name))
+                lItems.append((st.st_mtime, st.st_size, os.path.join(path, name)))
+            except OSError:
+                pass
+    return lItems
+
+def evict(limit):
+    """
+    Remove the least recently used entries until the cache size is below 'limit'
+    """
+    lItems = sorted(entries())
+    size = sum([item[1] for item in lItems])
+    for mtime, entry_size, path in lItems:
+        if size <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        size -= entry_size
+
+def stats():
+    """
+    Return a dict with hits, misses, number of entries, and cache size
+    """
+    dStats = read_stats()
+    lItems = entries()
+    dStats["entries"] = len(lItems)
+    dStats["size"] = sum([item[1] for item in lItems])
+    dStats["limit"] = cache_limit()
+    dStats["path"] = cache_dir()
+    return dStats
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# vm16asm - Macro Assembler for the VM16 CPU
+# Copyright (C) 2019-2021 Joe <iauit@gmx.de>
+#
+
+# v16asm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# v16asm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with v16asm.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Binary debug info file (.dbg) with address to source line mapping.
+
+File layout (all values little endian):
+  header:   magic 'V16D', version (H), start address (H), number of
+            addresses (I), number of files (I), number of symbols (I)
+  lines:    array('I') with (file-id, line-no) per address,
+            file-id 0xFFFFFFFF for unused addresses
+  types:    array('B') with the segment type per address (0xFF = unused)
+  symbols:  array('H') with the symbol addresses (sorted)
+  strings:  file names followed by symbol names, each terminated by '\0'
+"""
+
+import sys
+import mmap
+import struct
+import bisect
+from array import array
+
+MAGIC = b"V16D"
+FORMAT = 2
+HEADER = struct.Struct("<4sHHIII")
+UNUSED = 0xFFFFFFFF
+SegmentNames = ["CODE", "TEXT", "TEXT", "DATA"]
+
+def little_endian(arr):
+    if sys.byteorder == "big":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+def pack(start, size, lFiles, aLines, aTypes, dSymbols):
+    """
+    lFiles is the list of file names (index = file-id), aLines the
+    array('I') with (file-id, line-no) per address, aTypes the array('B')
+    with the segment types, dSymbols the symbol table.
+    Return the debug info as bytes.
+    """
+    lSymbols = sorted(dSymbols.items(), key=lambda item: (item[1], item[0]))
+    aAddr = array('H', [addr for name, addr in lSymbols])
+    strings = "\0".join(lFiles + [name for name, addr in lSymbols]) + "\0"
+    return HEADER.pack(MAGIC, FORMAT, start, size, len(lFiles), len(lSymbols)) + \
+        little_endian(aLines) + aTypes.tobytes() + little_endian(aAddr) + \
+        strings.encode("utf-8")
+
+class DebugInfo(object):
+    """
+    Memory mapped debug info file with O(1) address lookup
+    """
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.start, self.size, num_files, num_symbols = \
+            HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != FORMAT:
+            raise ValueError("Invalid debug info file '%s'" % filename)
+        offs = HEADER.size
+        mv = memoryview(self.mm)
+        self.aLines = self.array(mv[offs:offs + self.size * 8], 'I')
+        offs += self.size * 8
+        self.aTypes = mv[offs:offs + self.size]
+        offs += self.size
+        self.aAddr = self.array(mv[offs:offs + num_symbols * 2], 'H')
+        offs += num_symbols * 2
+        self.strings_offs = offs
+        self.num_files = num_files
+        self.lStrings = None
+
+    def array(self, mv, typecode):
+        if sys.byteorder == "big":
+            arr = array(typecode, mv.tobytes())
+            arr.byteswap()
+            return arr
+        return mv.cast(typecode)
+
+    def strings(self):
+        # Names are decoded on first use only
+        if self.lStrings is None:
+            data = self.mm[self.strings_offs:]
+            self.lStrings = data.decode("utf-8").split("\0")
+        return self.lStrings
+
+    def lookup(self, addr):
+        """
+        Return (filename, line-no) for the given address or None
+        """
+        idx = addr - self.start
+        if 0 <= idx < self.size:
+            file_id = self.aLines[idx * 2]
+            if file_id != UNUSED:
+                return self.strings()[file_id], self.aLines[idx * 2 + 1]
+        return None
+
+    def segment(self, addr):
+        """
+        Return the segment type "CODE", "DATA", "TEXT" or None
+        """
+        idx = addr - self.start
+        if 0 <= idx < self.size and self.aTypes[idx] < len(SegmentNames):
+            return SegmentNames[self.aTypes[idx]]
+        return None
+
+    def symbol(self, addr):
+        """
+        Return (symbol, offset) of the nearest symbol at or below addr, or None
+        """
+        idx = bisect.bisect_right(self.aAddr, addr) - 1
+        if idx >= 0:
+            idx = bisect.bisect_left(self.aAddr, self.aAddr[idx])
+            return self.strings()[self.num_files + idx], addr - self.aAddr[idx]
+        return None
+
+    def symbols(self):
+        """
+        Return the symbol table as dict
+        """
+        lNames = self.strings()[self.num_files:self.num_files + len(self.aAddr)]
+        return dict(zip(lNames, self.aAddr))
+
+    def close(self):
+        self.aLines = self.aTypes = self.aAddr = None
+        self.mm.close()
@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+#
+# vm16asm - Macro Assembler for the VM16 CPU
+# Copyright (C) 2019-2021 Joe <iauit@gmx.de>
+#
+
+# v16asm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# v16asm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with v16asm.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Differential fuzzing of the assembler.
+
+Random valid and invalid VM16 programs are generated from the Opcodes/Operands
+tables. Each program is assembled by the reference path (Tokenizer, AsmPass1,
+AsmPass2, locater) and by all registered alternative paths (incremental
+rebuild of the watch mode, library snapshots, multi-image locater). Memory images, symbols
+and error messages have to be identical, and the assembler must not crash.
+Failures are shrunk to a minimal program and stored as reproducer file.
+
+Usage:
+    python -m vm16asm.fuzz [--time <seconds>] [--seed <num>] [--out <dir>]
+"""
+
+import os
+import io
+import sys
+import random
+import shutil
+import tempfile
+import contextlib
+import traceback
+from . import assembler as asm
+from . import snapshot
+from .instructions import *
+
+FNAME = "fuzz.asm"
+LABELS = ["lab%u" % i for i in range(8)]
+ALIASES = ["VAL%u" % i for i in range(4)]
+MACRO = "mac"
+
+#
+# Program generator
+#
+def number(rnd, maxval=0xFFFF):
+    val = rnd.choice([0, 1, 2, rnd.randint(0, 15), rnd.randint(0, 255), rnd.randint(0, maxval)])
+    fmt = rnd.choice(["%u", "$%X", "0x%X", "0%o"])
+    if fmt == "0%o" and val == 0:
+        return "0"
+    return fmt % val
+
+def expression(rnd):
+    lOps = ["+", "-", "*", "/", "%", "<<", ">>", "&", "|"]
+    s = rnd.choice([number(rnd, 255), rnd.choice(LABELS), rnd.choice(ALIASES)])
+    for _ in range(rnd.randint(1, 2)):
+        op = rnd.choice(lOps)
+        val = str(rnd.randint(1, 4)) if op in ["/", "%", "<<", ">>"] else number(rnd, 255)
+        s = s + op + val
+    return "(" + s + ")" if rnd.random() < 0.3 else s
+
+def operand(rnd, group):
+    kind = rnd.choice(globals()[group])
+    if kind in REG or kind in ["[X]", "[Y]", "[X]+", "[Y]+"]:
+        return kind
+    if kind == "#0":
+        return rnd.choice(["#0", "#$0"])
+    if kind == "#1":
+        return rnd.choice(["#1", "#$1"])
+    if kind == "IMM":
+        return "#" + rnd.choice([number(rnd), rnd.choice(LABELS), rnd.choice(ALIASES), expression(rnd)])
+    if kind == "IND":
+        return rnd.choice([number(rnd), rnd.choice(LABELS), rnd.choice(ALIASES), expression(rnd)])
+    if kind == "REL":
+        return rnd.choice(["+", "-"]) + rnd.choice([number(rnd, 64), rnd.choice(LABELS)])
+    return "[SP+%s]" % rnd.choice([number(rnd, 255), rnd.choice(ALIASES)])
+
+def extra_word(opnd):
+    if opnd in REG or opnd in ["[X]", "[Y]", "[X]+", "[Y]+", "#0", "#$0", "#1", "#$1"]:
+        return False
+    return True
+
+def instruction(rnd):
+    opc, opnd1, opnd2 = rnd.choice(Opcodes).split(":")
+    lWords = [opc]
+    if opnd1 == "CNST" and Opcodes.index("%s:%s:%s" % (opc, opnd1, opnd2)) < 4:
+        lWords.append("#" + rnd.choice([number(rnd, 1023), rnd.choice(ALIASES)]))
+    elif opnd1 != "-":
+        lWords.append(operand(rnd, opnd1))
+    if opnd2 != "-":
+        lWords.append(operand(rnd, opnd2))
+        # only one operand with an additional word is allowed
+        while extra_word(lWords[1]) and extra_word(lWords[2]):
+            lWords[2] = operand(rnd, opnd2)
+    if len(lWords) == 1:
+        return "    " + opc
+    return "    %-5s %s" % (opc, ", ".join(lWords[1:]))
+
+def text(rnd):
+    chars = "abcXYZ 012!"
+    s = "".join([rnd.choice(chars) for _ in range(rnd.randint(0, 8))])
+    if rnd.random() < 0.7:
+        s += "\\0"
+    return '"%s"' % s
+
+def program(rnd):
+    """
+    Return the lines of a random program. Most programs are valid,
+    some are mutated to trigger error messages.
+    """
+    lLines = ["%s = %s" % (ALIASES[0], number(rnd, 255))]
+    for idx, name in enumerate(ALIASES[1:]):
+        # aliases refer to labels and previous aliases only
+        expr = expression(rnd)
+        for alias in ALIASES[idx + 1:]:
+            expr = expr.replace(alias, ALIASES[idx])
+        lLines.append("%s = %s" % (name, rnd.choice([number(rnd, 255), expr])))
+    macro = rnd.random() < 0.3
+    if macro:
+        lLines.append("$macro %s 1" % MACRO)
+        lLines.extend([instruction(rnd) for _ in range(rnd.randint(0, 2))])
+        lLines.append("    move  A, #%1")
+        lLines.append("$endmacro")
+    lLabels = list(LABELS)
+    rnd.shuffle(lLabels)
+    segment = ".code"
+    addr = 0
+    lConds = []  # open conditional blocks, True after $else
+    for idx in range(rnd.randint(5, 40)):
+        r = rnd.random()
+        if r < 0.05:
+            addr += rnd.randint(0x40, 0x400)
+            lLines.append("    .org $%X" % addr)
+        elif r < 0.15:
+            segment = rnd.choice([".code", ".data", ".text", ".ctext"])
+            lLines.append("    " + segment)
+        elif r < 0.2:
+            lLines.append(rnd.choice(["$if %s > %s" % (ALIASES[0], number(rnd, 255)),
+                                      "$ifdef " + rnd.choice(ALIASES),
+                                      "$ifndef " + rnd.choice(ALIASES + ["DEBUG"])]))
+            lConds.append(False)
+        elif r < 0.25 and lConds:
+            if not lConds[-1] and rnd.random() < 0.5:
+                lLines.append("$else")
+                lConds[-1] = True
+            else:
+                lLines.append("$endif")
+                lConds.pop()
+        label = ""
+        # labels in conditional blocks might be undefined
+        if lLabels and not lConds and rnd.random() < 0.25:
+            label = lLabels.pop() + ":"
+        if segment == ".code" and macro and rnd.random() < 0.1:
+            lLines.append(label)
+            lLines.append("    %s %s" % (MACRO, rnd.choice([number(rnd, 255), rnd.choice(LABELS)])))
+        elif segment == ".code":
+            lLines.append(label + instruction(rnd))
+        elif segment == ".data":
+            lLines.append(label + "  " + " ".join([number(rnd) for _ in range(rnd.randint(1, 4))]))
+        else:
+            lLines.append(label + "  " + text(rnd))
+    lLines.extend(["$endif"] * len(lConds))
+    lLines.extend(["    .code", "    halt"])
+    for label in lLabels:
+        lLines.append(label + ":")
+    if rnd.random() < 0.25:
+        mutate(rnd, lLines)
+    return lLines
+
+def mutate(rnd, lLines):
+    idx = rnd.randrange(len(lLines))
+    garbage = rnd.choice(["#", "[SP+]", "$G1", "0x", "09", "#lab", "+", "nolabel",
+                          "foo bar", "#(1", "1/0", "$10000", "[Z]"])
+    r = rnd.random()
+    if r < 0.4:
+        lLines[idx] = "    move  A, " + garbage
+    elif r < 0.6:
+        lLines[idx] = "    " + rnd.choice(["mov", "jmp", "bnz", "sys"]) + " " + garbage
+    elif r < 0.8:
+        lLines[idx] = lLines[idx] + ", " + garbage
+    else:
+        lLines.insert(idx, rnd.choice(LABELS) + ":")
+
+#
+# Assembler paths
+#
+def locate(lToken):
+    start, mem, last = asm.locater(lToken)
+    return dict([(start + idx, val) for idx, val in enumerate(mem) if val != -1])
+
+def assemble(path):
+    t = asm.Tokenizer(None, {})
+    lToken, lNameSpaces = t.load_file(path, FNAME, [])
+    a = asm.AsmPass1(lNameSpaces)
+    lToken = a.run(lToken)
+    lOrgs = a.lOrgs
+    a = asm.AsmPass2(lNameSpaces, a.dSymbols, a.dAliases)
+    return a.run(lToken), lOrgs, a.dSymbols
+
+def reference_path(path):
+    lToken, lOrgs, dSymbols = assemble(path)
+    return locate(lToken), dSymbols
+
+def edit(rnd, lLines):
+    """
+    Return a copy of the program lines with one line changed, inserted,
+    or deleted, like on a source file change in watch mode
+    """
+    lLines = list(lLines)
+    idx = rnd.randrange(len(lLines))
+    r = rnd.random()
+    if r < 0.4:
+        lLines[idx] = instruction(rnd)
+    elif r < 0.7:
+        lLines.insert(idx, rnd.choice([instruction(rnd), "", "; comment"]))
+    else:
+        del lLines[idx]
+    return lLines
+
+def watch_path(path):
+    """
+    Incremental build of the watch mode, after builds of edited variants
+    of the program with the same cache. Small segments are used, so that
+    the reuse of the file parts and segment results is exercised.
+    """
+    fname = os.path.join(path, FNAME)
+    lLines = open(fname).read().splitlines()
+    rnd = random.Random("\n".join(lLines))
+    dCache = {}
+    segment_lines = asm.SEGMENT_LINES
+    asm.SEGMENT_LINES = rnd.choice([1, 2, 4, 8])
+    try:
+        for _ in range(rnd.randint(1, 3)):
+            open(fname, "w").write("\n".join(edit(rnd, lLines)) + "\n")
+            try:
+                lToken, a, lOrgs, lFiles = asm.assemble(path, FNAME, dCache)
+                asm.locate(lToken, dCache)
+            except (SystemExit, Exception):
+                # edited variants may be invalid
+                pass
+        open(fname, "w").write("\n".join(lLines) + "\n")
+        lToken, a, lOrgs, lFiles = asm.assemble(path, FNAME, dCache)
+        start, mem, last = asm.locate(lToken, dCache)
+    finally:
+        asm.SEGMENT_LINES = segment_lines
+    return dict([(start + idx, val) for idx, val in enumerate(mem) if val != -1]), a.dSymbols
+
+def snapshot_path(path):
+    snapname = os.path.join(path, os.path.splitext(FNAME)[0] + snapshot.EXT)
+    try:
+        t = asm.Tokenizer(None, {})
+        lToken, lNameSpaces = t.load_file(path, FNAME, [])
+        snapshot.write(snapname, lToken, lNameSpaces, t.lFiles, t.dMacros, t.dAliases, {}, t.lUses)
+        if not asm.Tokenizer(None, {}).load_snapshot(os.path.join(path, FNAME), []):
+            raise RuntimeError("Snapshot not loaded")
+        lToken, lOrgs, dSymbols = assemble(path)
+        return locate(lToken), dSymbols
+    finally:
+        if os.path.exists(snapname):
+            os.remove(snapname)
+
+def split_images_path(path, by_segment=False):
+    lToken, lOrgs, dSymbols = assemble(path)
+    asm.locater(lToken)  # like in 'build', fails without code
+    dMem = {}
+    for name, l in asm.split_images(lToken, lOrgs, by_segment):
+        dMem.update(locate(l))
+    return dMem, dSymbols
+
+#
+# Alternative paths with their reference compatibility. The segment images
+# are located separately, so memory conflicts between code, text, and data
+# are not resolved like in the single image.
+#
+Paths = {
+    "watch": (watch_path, True),
+    "snapshot": (snapshot_path, True),
+    "split-org": (split_images_path, True),
+    "split-seg": (lambda path: split_images_path(path, True), False),
+}
+
+def run(func, path, out=None):
+    """
+    Run one assembler path with captured output.
+    Return ("ok", result), ("error", message) or ("crash", message)
+    """
+    out = out or io.StringIO()
+    try:
+        with contextlib.redirect_stdout(out):
+            return ("ok", func(path))
+    except SystemExit:
+        s = out.getvalue()
+        return ("error", s[s.rfind("Error"):].strip())
+    except Exception as e:
+        frame = traceback.extract_tb(sys.exc_info()[2])[-1]
+        return ("crash", "%s: %s (%s:%u)" % (type(e).__name__, e,
+                os.path.basename(frame.filename), frame.lineno))
+
+def check(path, lLines):
+    """
+    Assemble the program via all paths.
+    Return (reference result, list of failure descriptions)
+    """
+    open(os.path.join(path, FNAME), "w").write("\n".join(lLines) + "\n")
+    out = io.StringIO()
+    ref = run(reference_path, path, out)
+    conflicts = "Mem. loc. conflict" in out.getvalue()
+    lFailures = []
+    if ref[0] == "crash":
+        lFailures.append("reference crash: %s" % ref[1])
+    for name, (func, with_conflicts) in Paths.items():
+        if conflicts and not with_conflicts:
+            continue
+        res = run(func, path)
+        if res != ref:
+            lFailures.append("%s: %s" % (name, describe(ref, res)))
+    return ref, lFailures
+
+def describe(ref, res):
+    if ref[0] != res[0] or ref[0] != "ok":
+        return "%s '%s' instead of %s '%s'" % (res[0], res[1], ref[0], ref[1])
+    if ref[1][1] != res[1][1]:
+        return "symbol table differs"
+    lAddr = sorted(set(ref[1][0].items()) ^ set(res[1][0].items()))
+    return "memory differs at $%04X" % lAddr[0][0]
+
+def shrink(path, lLines, lFailures):
+    """
+    Remove line chunks as long as the first failure (path name) persists
+    """
+    kind = lFailures[0].split(":")[0]
+    fails = lambda l: [f for f in check(path, l)[1] if f.split(":")[0] == kind]
+    num = 2
+    while len(lLines) >= 2:
+        chunk = max(1, len(lLines) // num)
+        for idx in range(0, len(lLines), chunk):
+            lCand = lLines[:idx] + lLines[idx + chunk:]
+            if lCand and fails(lCand):
+                lLines = lCand
+                num = max(num - 1, 2)
+                break
+        else:
+            if chunk == 1:
+                break
+            num = min(num * 2, len(lLines))
+    return lLines, fails(lLines) or lFailures
+
+def fuzz(seconds=10, seed=None, outdir="."):
+    """
+    Generate and check programs for the given time.
+    Return the number of failures.
+    """
+    import time
+    seed = random.randrange(1 << 30) if seed is None else seed
+    print("VM16ASM fuzzer, seed %u, %u s" % (seed, seconds))
+    path = tempfile.mkdtemp(prefix="vm16fuzz") + "/"
+    dStats = {"ok": 0, "error": 0, "crash": 0}
+    failures = 0
+    t_end = time.time() + seconds
+    idx = 0
+    try:
+        while time.time() < t_end:
+            rnd = random.Random(seed + idx)
+            lLines = program(rnd)
+            ref, lFailures = check(path, lLines)
+            dStats[ref[0]] += 1
+            if lFailures:
+                failures += 1
+                lLines, lFailures = shrink(path, lLines, lFailures)
+                fname = os.path.join(outdir, "fuzz-%u.asm" % (seed + idx))
+                lComments = ["; " + s for f in lFailures for s in f.splitlines()]
+                open(fname, "w").write("\n".join(lComments + lLines) + "\n")
+                print(" - seed %u: %s (reproducer %s)" % (seed + idx, lFailures[0], fname))
+            idx += 1
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    print("%u programs (%u valid, %u with errors, %u crashes), %u failures" %
+          (idx, dStats["ok"], dStats["error"], dStats["crash"], failures))
+    return failures
+
+def main():
+    def option(name, default):
+        if name in sys.argv[:-1]:
+            return sys.argv[sys.argv.index(name) + 1]
+        return default
+    seed = option("--seed", None)
+    failures = fuzz(int(option("--time", 10)), seed and int(seed), option("--out", "."))
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
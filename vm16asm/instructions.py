@@ -48,6 +48,23 @@ Opcodes = [
 
 JumpInst = ["call", "jump", "bnze", "bze", "bpos", "bneg", "dbnz"]
 
+#
+# Estimated number of CPU cycles per instruction (without operand words).
+# Each additional operand word costs one more cycle.
+#
+Cycles = {
+    "nop": 1, "brk": 1, "sys": 2, "res2": 1,
+    "jump": 1, "call": 2, "ret": 2, "halt": 1,
+    "move": 1, "xchg": 2, "inc": 1, "dec": 1,
+    "add": 1, "sub": 1, "mul": 2, "div": 4,
+    "and": 1, "or": 1, "xor": 1, "not": 1,
+    "bnze": 1, "bze": 1, "bpos": 1, "bneg": 1,
+    "in": 2, "out": 2, "push": 1, "pop": 1,
+    "swap": 1, "dbnz": 1, "mod": 4,
+    "shl": 1, "shr": 1, "addc": 1, "mulc": 2,
+    "skne": 1, "skeq": 1, "sklt": 1, "skgt": 1,
+}
+
 #
 # Operands
 #
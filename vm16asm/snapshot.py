@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# vm16asm - Macro Assembler for the VM16 CPU
+# Copyright (C) 2019-2021 Joe <iauit@gmx.de>
+#
+
+# v16asm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# v16asm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with v16asm.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Library snapshots (.v16s files) with the preprocessed state of an .asm file
+and its include files: tokens, macros, name spaces, aliases, and the
+alias uses in conditions.
+
+File layout: magic 'V16S', format version (1 byte), followed by the
+marshal data of a dict. Snapshots are only valid for the same assembler
+and Python version.
+"""
+
+import os
+import sys
+import marshal
+from .instructions import VERSION
+
+MAGIC = b"V16S"
+FORMAT = 2
+EXT = ".v16s"
+
+def file_stamp(filename):
+    st = os.stat(filename)
+    return (filename, st.st_mtime_ns, st.st_size)
+
+def write(filename, lToken, lNameSpaces, lFiles, dMacros, dAliases, dDefines, lUses=None):
+    """
+    Write the preprocessed state as snapshot file
+    """
+    dData = {
+        "version": VERSION,
+        "python": tuple(sys.version_info[:2]),
+        "tokens": lToken,
+        "namespaces": lNameSpaces,
+        "files": [file_stamp(f) for f in lFiles],
+        "macros": dMacros,
+        "aliases": dAliases,
+        "defines": dDefines,
+        "uses": list(lUses or []),
+    }
+    data = MAGIC + bytes([FORMAT]) + marshal.dumps(dData)
+    tmpname = filename + ".tmp"
+    open(tmpname, "wb").write(data)
+    os.replace(tmpname, filename)
+    return len(data)
+
+def read(filename, dDefines):
+    """
+    Return the snapshot data as dict, or None if the snapshot is invalid
+    or one of the source files was changed.
+    """
+    try:
+        data = open(filename, "rb").read()
+        if data[0:4] != MAGIC or data[4] != FORMAT:
+            return None
+        dData = marshal.loads(data[5:])
+        if dData["version"] != VERSION or \
+                dData["python"] != tuple(sys.version_info[:2]) or \
+                dData["defines"] != dDefines:
+            return None
+        for item in dData["files"]:
+            if tuple(file_stamp(item[0])) != tuple(item):
+                return None
+        return dData
+    except (OSError, EOFError, ValueError, TypeError, KeyError, IndexError):
+        return None
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# vm16asm - Macro Assembler for the VM16 CPU
+# Copyright (C) 2019-2021 Joe <iauit@gmx.de>
+#
+
+# v16asm is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# v16asm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with v16asm.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+File watchers for the '--watch' mode.
+On Linux, inotify is used (via ctypes), otherwise the files are polled.
+"""
+
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+class InotifyWatcher(object):
+    name = "inotify"
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.dDirs = {}  # {wd: path}
+
+    def add_dir(self, path):
+        # Directories are watched, because editors often replace files
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(), mask)
+        if wd >= 0:
+            self.dDirs[wd] = path
+
+    def read_events(self):
+        data = os.read(self.fd, 64 * 1024)
+        idx = 0
+        lPaths = []
+        while idx + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, size = EVENT_HEADER.unpack_from(data, idx)
+            idx += EVENT_HEADER.size
+            name = data[idx:idx + size].rstrip(b"\0").decode(errors="replace")
+            idx += size
+            if wd in self.dDirs:
+                lPaths.append(os.path.join(self.dDirs[wd], name))
+        return lPaths
+
+    def wait(self, lFiles):
+        """
+        Block until one of the files is changed.
+        Return the set of changed files.
+        """
+        lFiles = set(lFiles)
+        for path in set([os.path.dirname(f) for f in lFiles]):
+            if path not in self.dDirs.values():
+                self.add_dir(path)
+        while True:
+            select.select([self.fd], [], [])
+            lChanged = set(self.read_events()) & lFiles
+            # collect further events, queued by the same save operation
+            while select.select([self.fd], [], [], 0)[0]:
+                lChanged |= set(self.read_events()) & lFiles
+            if lChanged:
+                return lChanged
+
+class PollingWatcher(object):
+    name = "polling"
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.dStamps = {}
+
+    def stamp(self, filename):
+        try:
+            st = os.stat(filename)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def wait(self, lFiles):
+        for filename in lFiles:
+            if filename not in self.dStamps:
+                self.dStamps[filename] = self.stamp(filename)
+        while True:
+            time.sleep(self.interval)
+            lChanged = set()
+            for filename in lFiles:
+                stamp = self.stamp(filename)
+                if stamp != self.dStamps[filename]:
+                    self.dStamps[filename] = stamp
+                    lChanged.add(filename)
+            if lChanged:
+                return lChanged
+
+def Watcher():
+    """
+    Return an inotify based watcher, or the polling watcher as fallback
+    """
+    try:
+        return InotifyWatcher()
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher()